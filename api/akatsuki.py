@@ -5,6 +5,7 @@ from common.utils import try_get
 from common.app import database
 from typing import List, Tuple
 
+import threading
 import requests
 import time
 
@@ -13,13 +14,16 @@ class AkatsukiAPI(ServerAPI):
     def __init__(self):
         super().__init__("akatsuki", supports_rx=True, supports_clans=True, supports_lb_tracking=True)
         self._last_response = time.time()
+        self._rate_limit = threading.Lock()
     
     def _get(self, url) -> requests.Response:
-        delta = time.time() - self._last_response
-        delay = 60/120
-        if delta < delay:
-            time.sleep(delay - delta)
-        self._last_response = time.time()
+        # Map statuses are resolved from a background thread
+        with self._rate_limit:
+            delta = time.time() - self._last_response
+            delay = 60/120
+            if delta < delay:
+                time.sleep(delay - delta)
+            self._last_response = time.time()
         return requests.get(url)
 
     def _convert_score(self, json: dict, user_id: int, relax: int, beatmap_id: int = 0) -> Score:
@@ -283,10 +287,10 @@ class AkatsukiAPI(ServerAPI):
                 stats.append(self._convert_stats(json['stats'][rx][modes[m]], user_id, m, rx, first_places=count, full=True))
         return self._convert_user(json), stats
 
-    def get_map_status(self, beatmap_id: int) -> int:
+    def get_map_status(self, beatmap_id: int) -> int | None:
         req = self._get(f"https://akatsuki.gg/api/v1/beatmaps?b={beatmap_id}")
         if not req.ok:
-            return -2
+            return None
         return req.json()['ranked']-1
     
     def get_map_scores(self, beatmap_id: int, mode: int, relax: int, page: int = 1, length: int = 100) -> List[Score]:
@@ -8,7 +8,9 @@ from common.api.server_api import *
 from common.app import ossapi
 
 
-from typing import List, Tuple
+from typing import Dict, List, Tuple
+
+import time
 
 class BanchoAPI(ServerAPI):
     
@@ -169,11 +171,19 @@ class BanchoAPI(ServerAPI):
             stats.append(self._convert_stats(current_mode_profile.statistics, mode))
         return self._convert_user(current_mode_profile), stats
 
-    def get_map_status(self, beatmap_id: int) -> int:
+    def get_map_status(self, beatmap_id: int) -> int | None:
         try:
             return ossapi.beatmap(beatmap_id=beatmap_id).status.value
         except ValueError:
-            return -2
+            return None
+
+    def get_map_statuses(self, beatmap_ids: List[int]) -> Dict[int, int]:
+        # 50 beatmaps per request, unknown ones aren't part of the response
+        statuses = {}
+        for i in range(0, len(beatmap_ids), 50):
+            statuses.update({beatmap.id: beatmap.status.value for beatmap in ossapi.beatmaps(beatmap_ids[i:i+50])})
+            time.sleep(0.4)
+        return statuses
 
     def get_leaderboard(self, mode: int, relax: int, page: int, length: int, inactive=False, sort: SortType = SortType.PP) -> List[Tuple[User, Stats]] | None:
         return [(self._convert_user_compact(stats.user), self._convert_stats(stats, mode)) for stats in ossapi.ranking(mode=self._mode(mode), type=RankingType.PERFORMANCE if sort == SortType.PP else RankingType.SCORE, cursor=Cursor(page=page, length=length)).ranking]
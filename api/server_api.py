@@ -1,6 +1,6 @@
 from common.database.objects import *
 from dataclasses import dataclass
-from typing import Tuple, List
+from typing import Dict, Tuple, List
 
 import datetime
 
@@ -327,6 +327,14 @@ class ServerAPI:
 
     def get_map_status(self, beatmap_id: int) -> int:
         return -2
+
+    def get_map_statuses(self, beatmap_ids: List[int]) -> Dict[int, int]:
+        # Beatmaps that couldn't be looked up are left out
+        statuses = {}
+        for beatmap_id in beatmap_ids:
+            if (status := self.get_map_status(beatmap_id)) is not None:
+                statuses[beatmap_id] = status
+        return statuses
     
     def get_map_scores(self, beatmap_id: int, mode: int, relax: int, page: int = 1, length: int = 100) -> List[Score]:
         return None
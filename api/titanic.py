@@ -3,6 +3,7 @@ from common.api.server_api import *
 
 from typing import List, Tuple
 
+import threading
 import requests
 import time
 
@@ -13,13 +14,16 @@ class TitanicAPI(ServerAPI):
     def __init__(self):
         super().__init__("titanic", supports_lb_tracking=True)
         self._last_response = time.time()
+        self._rate_limit = threading.Lock()
     
     def _get(self, url) -> requests.Response:
-        delta = time.time() - self._last_response
-        delay = 60/120
-        if delta < delay:
-            time.sleep(delay - delta)
-        self._last_response = time.time()
+        # Map statuses are resolved from a background thread
+        with self._rate_limit:
+            delta = time.time() - self._last_response
+            delay = 60/120
+            if delta < delay:
+                time.sleep(delay - delta)
+            self._last_response = time.time()
         return requests.get(url)
 
     def _convert_user(self, json: dict) -> User:
@@ -198,10 +202,10 @@ class TitanicAPI(ServerAPI):
     def get_user_pfp(self, user_id: int) -> str:
         return f"https://osu.lekuru.xyz/a/{user_id}"
     
-    def get_map_status(self, beatmap_id: int) -> int:
+    def get_map_status(self, beatmap_id: int) -> int | None:
         req = self._get(f"https://osu.lekuru.xyz/api/beatmaps/{beatmap_id}")
         if not req.ok:
-            return -2
+            return None
         return req.json()['status']
     
     def ping_server(self) -> bool:
@@ -0,0 +1,214 @@
+# Packs uncompressed beatmaps into large segment files read through mmap, so hot maps skip
+# opening and decompressing their .osu.gz. The per-file layout stays the source of truth:
+# entries are only served while the file they were packed from is unchanged.
+#
+#   python -m common.beatmap_archive rebuild --hot 200000
+#   python -m common.beatmap_archive rebuild --ids ids.txt
+#   python -m common.beatmap_archive stats
+#   python -m common.beatmap_archive clear
+from common.beatmap_store import beatmap_store
+from common.logging import get_logger
+from common.app import config
+
+from typing import Dict, Iterable, Tuple
+from pathlib import Path
+
+import threading
+import argparse
+import sqlite3
+import hashlib
+import mmap
+import os
+
+logger = get_logger("beatmap_archive")
+
+INDEX_FILENAME = "index.sqlite3"
+SEGMENT_SIZE = 256 * 1024 * 1024
+
+class BeatmapArchive:
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._segments: Dict[str, mmap.mmap] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def _connection(self) -> sqlite3.Connection | None:
+        index = os.path.join(self.directory, INDEX_FILENAME)
+        try:
+            inode = os.stat(index).st_ino
+        except FileNotFoundError:
+            return None
+        # A rebuild swaps in a new index, reopen it when that happens
+        if getattr(self._local, 'inode', None) != inode:
+            if (connection := getattr(self._local, 'connection', None)):
+                connection.close()
+            self._local.connection = sqlite3.connect(f"file:{index}?mode=ro", uri=True)
+            self._local.inode = inode
+            self._release_segments(self._local.connection)
+        return self._local.connection
+
+    def _release_segments(self, connection: sqlite3.Connection):
+        # Segments of older generations are deleted by the rebuild, their mappings would keep the disk space in use
+        current = {name for name, in connection.execute("SELECT DISTINCT segment FROM entries")}
+        with self._lock:
+            for name in [name for name in self._segments if name not in current]:
+                self._close_segment(self._segments.pop(name))
+
+    @staticmethod
+    def _close_segment(segment: mmap.mmap):
+        try:
+            segment.close()
+        except BufferError:
+            pass # Still referenced by a view, it's released with it
+
+    def _segment(self, name: str) -> mmap.mmap | None:
+        with self._lock:
+            if (segment := self._segments.get(name)) is None:
+                try:
+                    with open(os.path.join(self.directory, name), "rb") as f:
+                        segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                except FileNotFoundError:
+                    return None
+                self._segments[name] = segment
+            return segment
+
+    def get(self, beatmap_id: int) -> Tuple[memoryview, str] | None:
+        if not (connection := self._connection):
+            return None
+        row = connection.execute(
+            "SELECT md5, segment, offset, length, size, mtime FROM entries WHERE id = ?",
+            (beatmap_id,)
+        ).fetchone()
+        if not row:
+            return None
+        md5, name, offset, length, size, mtime = row
+        try:
+            stat = os.stat(beatmap_store().path(beatmap_id))
+            if stat.st_size != size or stat.st_mtime_ns != mtime:
+                return None
+        except FileNotFoundError:
+            pass
+        if not (segment := self._segment(name)):
+            return None
+        return memoryview(segment)[offset:offset + length], md5
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments.values():
+                self._close_segment(segment)
+            self._segments.clear()
+
+    def rebuild(self, beatmap_ids: Iterable[int], segment_size: int = SEGMENT_SIZE) -> int:
+        store = beatmap_store()
+        generation = hashlib.md5(os.urandom(16)).hexdigest()[:8]
+        index = os.path.join(self.directory, f"{INDEX_FILENAME}.{generation}")
+        connection = sqlite3.connect(index)
+        connection.execute("CREATE TABLE entries (id INTEGER PRIMARY KEY, md5 TEXT NOT NULL, segment TEXT NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL)")
+        packed = 0
+        segment_number = 0
+        segment = None
+        try:
+            for beatmap_id in beatmap_ids:
+                try:
+                    stat = os.stat(store.path(beatmap_id))
+                except FileNotFoundError:
+                    continue
+                if not (beatmap := store.read(beatmap_id)):
+                    continue
+                data, md5 = beatmap
+                if segment is None or segment.tell() + len(data) > segment_size:
+                    if segment:
+                        segment.close()
+                    name = f"segment-{generation}-{segment_number:05d}.bin"
+                    segment = open(os.path.join(self.directory, name), "wb")
+                    segment_number += 1
+                connection.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (beatmap_id, md5, name, segment.tell(), len(data), stat.st_size, stat.st_mtime_ns)
+                )
+                segment.write(data)
+                packed += 1
+            if segment:
+                segment.flush()
+                os.fsync(segment.fileno())
+                segment.close()
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(index, os.path.join(self.directory, INDEX_FILENAME))
+        # Processes with an old index open fall back to the per-file layout once its segments are gone
+        for path in Path(self.directory).glob("segment-*.bin"):
+            if not path.name.startswith(f"segment-{generation}-"):
+                path.unlink(missing_ok=True)
+        self.close()
+        return packed
+
+    def clear(self):
+        Path(os.path.join(self.directory, INDEX_FILENAME)).unlink(missing_ok=True)
+        for path in Path(self.directory).glob("segment-*.bin"):
+            path.unlink(missing_ok=True)
+        self.close()
+
+    def stats(self) -> dict:
+        if not (connection := self._connection):
+            return {'entries': 0, 'bytes': 0, 'segments': 0}
+        entries, total = connection.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM entries").fetchone()
+        segments = connection.execute("SELECT COUNT(DISTINCT segment) FROM entries").fetchone()[0]
+        return {'entries': entries, 'bytes': total, 'segments': segments}
+
+_archives: Dict[str, BeatmapArchive] = {}
+_archives_lock = threading.Lock()
+
+def beatmap_archive() -> BeatmapArchive | None:
+    if not getattr(config, 'beatmap_archive', False):
+        return None
+    directory = f"{config.storage}/beatmaps/archive"
+    with _archives_lock:
+        if directory not in _archives:
+            _archives[directory] = BeatmapArchive(directory)
+        return _archives[directory]
+
+def _hot_beatmaps(limit: int) -> list:
+    from common.database.objects import DBScore
+    from common.app import database
+    from sqlalchemy import func
+    with database.managed_session() as session:
+        query = session.query(DBScore.beatmap_id).group_by(DBScore.beatmap_id).order_by(func.count().desc()).limit(limit)
+        return [beatmap_id for beatmap_id, in query]
+
+def _stored_beatmaps() -> list:
+    return sorted(int(path.name.split(".")[0]) for path in Path(f"{config.storage}/beatmaps").glob("*.osu.gz"))
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the packed beatmap archive")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rebuild = subparsers.add_parser("rebuild", help="Pack beatmaps into new segments, replacing the current archive")
+    rebuild.add_argument("--hot", type=int, help="Only pack the N beatmaps with the most scores")
+    rebuild.add_argument("--ids", help="Only pack the beatmap ids listed in this file, one per line")
+    rebuild.add_argument("--segment-size", type=int, default=SEGMENT_SIZE // 1024 // 1024, help="Segment size in MiB")
+    subparsers.add_parser("stats", help="Show archive statistics")
+    subparsers.add_parser("clear", help="Delete the archive, going back to the per-file layout")
+    args = parser.parse_args()
+
+    archive = BeatmapArchive(f"{config.storage}/beatmaps/archive")
+    if args.command == "stats":
+        print(archive.stats())
+        return
+    if args.command == "clear":
+        archive.clear()
+        return
+    if args.ids:
+        with open(args.ids) as f:
+            beatmap_ids = [int(line) for line in f if line.strip()]
+    elif args.hot:
+        beatmap_ids = _hot_beatmaps(args.hot)
+    else:
+        beatmap_ids = _stored_beatmaps()
+    packed = archive.rebuild(beatmap_ids, segment_size=args.segment_size * 1024 * 1024)
+    logger.info(f"Packed {packed} beatmaps into {archive.stats()['segments']} segments")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+from common.files import BinaryFile, Codec, get_codec
+from common.app import config
+
+from typing import Dict, Tuple
+from pathlib import Path
+
+import threading
+import sqlite3
+import hashlib
+import os
+
+INDEX_FILENAME = "index.sqlite3"
+
+class BeatmapStore:
+
+    def __init__(self, directory: str, codec: str | Codec | None = None) -> None:
+        self.directory = directory
+        self.codec = get_codec(codec)
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._execute("CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, md5 TEXT NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL)")
+        self._execute("CREATE INDEX IF NOT EXISTS files_md5 ON files (md5)")
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite connections can't be shared between threads
+        if not (connection := getattr(self._local, 'connection', None)):
+            connection = sqlite3.connect(os.path.join(self.directory, INDEX_FILENAME), timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def _execute(self, query: str, params: tuple = ()) -> sqlite3.Cursor:
+        return self._connection.execute(query, params)
+
+    def path(self, beatmap_id: int) -> str:
+        return f"{self.directory}/{beatmap_id}.osu.gz"
+
+    def _stat(self, beatmap_id: int) -> os.stat_result | None:
+        try:
+            return os.stat(self.path(beatmap_id))
+        except FileNotFoundError:
+            return None
+
+    def _record(self, beatmap_id: int, md5: str, stat: os.stat_result):
+        self._execute(
+            "INSERT OR REPLACE INTO files (id, md5, size, mtime) VALUES (?, ?, ?, ?)",
+            (beatmap_id, md5, stat.st_size, stat.st_mtime_ns)
+        )
+
+    def _indexed_hash(self, beatmap_id: int, stat: os.stat_result) -> str | None:
+        row = self._execute("SELECT md5, size, mtime FROM files WHERE id = ?", (beatmap_id,)).fetchone()
+        # Files replaced without going through the store are hashed again
+        if row and row[1] == stat.st_size and row[2] == stat.st_mtime_ns:
+            return row[0]
+        return None
+
+    def exists(self, beatmap_id: int) -> bool:
+        return self._stat(beatmap_id) is not None
+
+    def get_hash(self, beatmap_id: int) -> str | None:
+        if not (stat := self._stat(beatmap_id)):
+            return None
+        if (md5 := self._indexed_hash(beatmap_id, stat)):
+            return md5
+        if (beatmap := self.read(beatmap_id)):
+            return beatmap[1]
+        return None
+
+    def read(self, beatmap_id: int) -> Tuple[bytes, str] | None:
+        if not (stat := self._stat(beatmap_id)):
+            return None
+        file = BinaryFile(self.path(beatmap_id))
+        file.load_data()
+        if not file.data:
+            return None
+        if not (md5 := self._indexed_hash(beatmap_id, stat)):
+            md5 = hashlib.md5(file.data).hexdigest()
+            self._record(beatmap_id, md5, stat)
+        return file.data, md5
+
+    def write(self, beatmap_id: int, content: bytes) -> str:
+        file = BinaryFile(self.path(beatmap_id), codec=self.codec)
+        file.data = content
+        file.save_data()
+        md5 = hashlib.md5(content).hexdigest()
+        if (stat := self._stat(beatmap_id)):
+            self._record(beatmap_id, md5, stat)
+        return md5
+
+    def find(self, md5: str) -> int | None:
+        for (beatmap_id,) in self._execute("SELECT id FROM files WHERE md5 = ?", (md5,)).fetchall():
+            if self.get_hash(beatmap_id) == md5:
+                return beatmap_id
+        return None
+
+    def rebuild(self) -> int:
+        # Hashes every file that isn't indexed yet or changed since, and drops deleted ones
+        indexed = 0
+        known = set()
+        for path in Path(self.directory).glob("*.osu.gz"):
+            try:
+                beatmap_id = int(path.name.split(".")[0])
+            except ValueError:
+                continue
+            known.add(beatmap_id)
+            if (stat := self._stat(beatmap_id)) and not self._indexed_hash(beatmap_id, stat):
+                if self.read(beatmap_id):
+                    indexed += 1
+        for (beatmap_id,) in self._execute("SELECT id FROM files").fetchall():
+            if beatmap_id not in known:
+                self._execute("DELETE FROM files WHERE id = ?", (beatmap_id,))
+        return indexed
+
+_stores: Dict[str, BeatmapStore] = {}
+_stores_lock = threading.Lock()
+
+def beatmap_store() -> BeatmapStore:
+    directory = f"{config.storage}/beatmaps"
+    with _stores_lock:
+        if directory not in _stores:
+            # Existing files stay readable when this changes, see `python -m common.files` to migrate them
+            _stores[directory] = BeatmapStore(directory, getattr(config, 'beatmap_codec', None))
+        return _stores[directory]
@@ -0,0 +1,89 @@
+# Compares read and write throughput of the file codecs on beatmap files.
+#
+#   python -m common.benchmarks.codecs --output codecs.json
+#   python -m common.benchmarks.codecs --corpus ~/corpus --codecs raw,zlib:1,gzip:6,gzip:9
+from common.benchmarks.corpus import synthetic_corpus, load_corpus, corpus_fingerprint
+from common.benchmarks.harness import metadata, summarize, write_report
+from common.files import BinaryFile, decode, get_codec
+
+import argparse
+import tempfile
+import shutil
+import time
+import os
+
+CODECS = ["raw", "zlib:1", "zlib:6", "gzip:1", "gzip:6", "gzip:9"]
+
+def _throughput(samples: list, total_bytes: int) -> dict:
+    elapsed = sum(samples)
+    return {
+        **summarize(samples),
+        'mb_per_s': total_bytes / elapsed / 1024 / 1024 if elapsed else 0.0,
+    }
+
+def benchmark_codec(spec: str, payloads: list, directory: str, repeats: int) -> dict:
+    codec = get_codec(spec)
+    raw_bytes = sum(len(payload) for payload in payloads) * repeats
+    encoded, decoded, written, read = [], [], [], []
+    encoded_bytes = 0
+    for _ in range(repeats):
+        for index, payload in enumerate(payloads):
+            start = time.perf_counter()
+            blob = codec.encode(payload)
+            encoded.append(time.perf_counter() - start)
+            encoded_bytes += len(blob)
+
+            start = time.perf_counter()
+            decode(blob)
+            decoded.append(time.perf_counter() - start)
+
+            # Through BinaryFile, including the atomic rename and fsync of every write
+            file = BinaryFile(os.path.join(directory, f"{index}.osu.gz"), codec=codec)
+            file.data = payload
+            start = time.perf_counter()
+            file.save_data()
+            written.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            BinaryFile(file.filepath).load_data()
+            read.append(time.perf_counter() - start)
+    return {
+        'codec': repr(codec),
+        'ratio': encoded_bytes / raw_bytes if raw_bytes else 0.0,
+        'encode': _throughput(encoded, raw_bytes),
+        'decode': _throughput(decoded, raw_bytes),
+        'write_file': _throughput(written, raw_bytes),
+        'read_file': _throughput(read, raw_bytes),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark file codecs")
+    parser.add_argument("--corpus", help="Directory of {beatmap_id}.osu.gz files (default: synthetic corpus)")
+    parser.add_argument("--codecs", default=",".join(CODECS))
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(seed=args.seed)
+    payloads = [beatmap.data for beatmap in corpus]
+    report = {
+        'meta': metadata(
+            corpus='synthetic' if not args.corpus else args.corpus,
+            corpus_fingerprint=corpus_fingerprint(corpus),
+            beatmaps=len(corpus),
+            bytes=sum(len(payload) for payload in payloads),
+            repeats=args.repeats,
+        ),
+        'results': {},
+    }
+    for spec in args.codecs.split(","):
+        directory = tempfile.mkdtemp(prefix="codec-bench-")
+        try:
+            report['results'][spec] = benchmark_codec(spec, payloads, directory, args.repeats)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    write_report(report, args.output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+from typing import Dict, List, Tuple
+from dataclasses import dataclass
+from pathlib import Path
+
+import hashlib
+import random
+import gzip
+
+# Beatmap ids used for the synthetic corpus, far away from real osu! ids
+SYNTHETIC_ID_BASE = 900000000
+MODE_NAMES = ['osu', 'taiko', 'fruits', 'mania']
+
+@dataclass
+class CorpusBeatmap:
+    id: int
+    mode: int
+    md5: str
+    objects: int
+    data: bytes
+
+def _hit_objects(rng: random.Random, mode: int, objects: int, beat_length: float, keys: int) -> Tuple[List[str], int]:
+    lines = []
+    time = 1000
+    step = int(beat_length / 2)
+    for index in range(objects):
+        kind = rng.random()
+        if mode == 3:
+            column = rng.randrange(keys)
+            x = int(column * 512 / keys + 256 / keys)
+            if kind < 0.2:
+                lines.append(f"{x},192,{time},128,0,{time + step * 2}:0:0:0:0:")
+            else:
+                lines.append(f"{x},192,{time},1,0,0:0:0:0:")
+        elif kind < 0.02 and index:
+            lines.append(f"256,192,{time},12,0,{time + step * 4},0:0:0:0:")
+            time += step * 4
+        elif kind < 0.35:
+            x, y = rng.randrange(64, 448), rng.randrange(64, 320)
+            length = rng.choice((70, 140, 210))
+            lines.append(f"{x},{y},{time},2,0,L|{min(x + length, 511)}:{y},1,{length}")
+            time += step * 2
+        else:
+            hitsound = rng.choice((0, 2, 8, 4)) if mode == 1 else 0
+            lines.append(f"{rng.randrange(0, 512)},{rng.randrange(0, 384)},{time},1,{hitsound},0:0:0:0:")
+        time += step
+    return lines, time
+
+def generate_beatmap(beatmap_id: int, mode: int, objects: int, seed: int) -> bytes:
+    rng = random.Random(seed * 7919 + beatmap_id)
+    beat_length = 60000 / rng.choice((120, 150, 180, 200, 240))
+    keys = rng.choice((4, 7)) if mode == 3 else 0
+    lines, _ = _hit_objects(rng, mode, objects, beat_length, keys)
+    content = "\n".join([
+        "osu file format v14",
+        "",
+        "[General]",
+        "AudioFilename: audio.mp3",
+        f"Mode: {mode}",
+        "",
+        "[Metadata]",
+        f"Title:Benchmark {beatmap_id}",
+        "Artist:common",
+        "Creator:benchmark",
+        f"Version:{MODE_NAMES[mode]} {objects}",
+        f"BeatmapID:{beatmap_id}",
+        "BeatmapSetID:-1",
+        "",
+        "[Difficulty]",
+        f"HPDrainRate:{rng.choice((4, 5, 6))}",
+        f"CircleSize:{keys if mode == 3 else rng.choice((3, 4, 5))}",
+        f"OverallDifficulty:{rng.choice((7, 8, 9))}",
+        f"ApproachRate:{rng.choice((8, 9, 9.5))}",
+        "SliderMultiplier:1.4",
+        "SliderTickRate:1",
+        "",
+        "[TimingPoints]",
+        f"0,{beat_length},4,2,0,50,1,0",
+        "",
+        "[HitObjects]",
+        *lines,
+        "",
+    ])
+    return content.encode("utf-8")
+
+def synthetic_corpus(seed: int = 0, sizes: Tuple[int, ...] = (300, 1000, 3000)) -> List[CorpusBeatmap]:
+    beatmaps = []
+    beatmap_id = SYNTHETIC_ID_BASE
+    for mode in range(4):
+        for objects in sizes:
+            data = generate_beatmap(beatmap_id, mode, objects, seed)
+            beatmaps.append(CorpusBeatmap(beatmap_id, mode, hashlib.md5(data).hexdigest(), objects, data))
+            beatmap_id += 1
+    return beatmaps
+
+def load_corpus(directory: str) -> List[CorpusBeatmap]:
+    beatmaps = []
+    for path in sorted(Path(directory).glob("*.osu.gz")):
+        data = gzip.decompress(path.read_bytes())
+        mode = 0
+        objects = 0
+        in_objects = False
+        for line in data.decode("utf-8", errors="ignore").splitlines():
+            line = line.strip()
+            if line.startswith("Mode:"):
+                mode = int(line.split(":", 1)[1])
+            elif line == "[HitObjects]":
+                in_objects = True
+            elif in_objects and line:
+                objects += 1
+        beatmap_id = int(path.name.split(".")[0])
+        beatmaps.append(CorpusBeatmap(beatmap_id, mode, hashlib.md5(data).hexdigest(), objects, data))
+    return beatmaps
+
+def corpus_fingerprint(beatmaps: List[CorpusBeatmap]) -> str:
+    digest = hashlib.md5()
+    for beatmap in beatmaps:
+        digest.update(f"{beatmap.id}:{beatmap.md5};".encode())
+    return digest.hexdigest()
+
+def write_corpus(beatmaps: List[CorpusBeatmap], storage: str) -> Dict[int, CorpusBeatmap]:
+    target = Path(storage) / "beatmaps"
+    target.mkdir(parents=True, exist_ok=True)
+    for beatmap in beatmaps:
+        with gzip.open(target / f"{beatmap.id}.osu.gz", "wb") as f:
+            f.write(beatmap.data)
+    return {beatmap.id: beatmap for beatmap in beatmaps}
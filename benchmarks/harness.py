@@ -0,0 +1,77 @@
+from typing import Callable, Iterable, List
+from datetime import datetime
+
+import statistics
+import platform
+import types
+import json
+import time
+import sys
+
+class _Offline:
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+
+    def __getattr__(self, attribute: str):
+        raise RuntimeError(f"Benchmarks run offline, {self.name}.{attribute} isn't available")
+
+def offline_app():
+    # common.app connects to postgres and sets up the osu! API client on import,
+    # this has to run before importing anything that pulls it in
+    if 'common.app' in sys.modules:
+        return sys.modules['common.app']
+    from common.events import EventHandler
+    from config import Config
+    import common
+
+    app = types.ModuleType('common.app')
+    app.STOPPED = False
+    app.config = Config()
+    app.database = _Offline('database')
+    app.ossapi = _Offline('ossapi')
+    app.events = EventHandler()
+    sys.modules['common.app'] = common.app = app
+    return app
+
+def summarize(samples: List[float]) -> dict:
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'total_s': sum(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'median_ms': statistics.median(ordered) * 1000,
+        'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        'min_ms': ordered[0] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+def measure(func: Callable, items: Iterable, before: Callable | None = None) -> dict:
+    samples = []
+    for item in items:
+        if before:
+            before(item)
+        start = time.perf_counter()
+        func(item)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+def metadata(**extra) -> dict:
+    return {
+        'date': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        **extra,
+    }
+
+def write_report(report: dict, output: str | None):
+    data = json.dumps(report, indent=2, sort_keys=True, default=str)
+    if not output or output == "-":
+        print(data)
+        return
+    with open(output, "w") as f:
+        f.write(data)
@@ -0,0 +1,79 @@
+# Measures the cold import time of common modules in fresh interpreters and checks that
+# importing them doesn't load the pp calculator extensions.
+#
+#   python -m common.benchmarks.import_time --output imports.json
+#   python -m common.benchmarks.import_time --max-ms 2000   # exit code 1 on regression
+from common.benchmarks.harness import metadata, summarize, write_report
+
+from typing import List
+
+import subprocess
+import argparse
+import json
+import sys
+import os
+
+MODULES = ["common.performance", "common.api.server_api", "common.servers"]
+
+# Only imported once a pp calculation actually needs them
+LAZY_MODULES = ["akatsuki_pp_py", "rosu_pp_py", "titanic_pp_py", "common.repos.beatmaps"]
+
+PROBE = """
+import importlib, json, sys, time
+start = time.perf_counter()
+importlib.import_module(sys.argv[1])
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'loaded': [name for name in json.loads(sys.argv[2]) if name in sys.modules], 'modules': len(sys.modules)}))
+"""
+
+def _slowest_imports(stderr: str, count: int = 10) -> List[dict]:
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        imports.append({'module': name.strip(), 'self_ms': int(self_us) / 1000, 'cumulative_ms': int(cumulative_us) / 1000})
+    return sorted(imports, key=lambda item: item['cumulative_ms'], reverse=True)[:count]
+
+def probe(module: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE, module, json.dumps(LAZY_MODULES)],
+        capture_output=True, text=True, env=env, check=True
+    )
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    result['slowest'] = _slowest_imports(process.stderr)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark import time of common modules")
+    parser.add_argument("--modules", default=",".join(MODULES))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, help="Fail if the median import time of any module exceeds this")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    report = {'meta': metadata(runs=args.runs, lazy_modules=LAZY_MODULES), 'results': {}}
+    failures = []
+    for module in args.modules.split(","):
+        runs = [probe(module) for _ in range(args.runs)]
+        result = {
+            **summarize([run['elapsed'] for run in runs]),
+            'modules_loaded': runs[-1]['modules'],
+            'eagerly_loaded': runs[-1]['loaded'],
+            'slowest': runs[-1]['slowest'],
+        }
+        report['results'][module] = result
+        if result['eagerly_loaded']:
+            failures.append(f"{module} eagerly imports {', '.join(result['eagerly_loaded'])}")
+        if args.max_ms is not None and result['median_ms'] > args.max_ms:
+            failures.append(f"{module} took {result['median_ms']:.0f}ms (limit: {args.max_ms:.0f}ms)")
+
+    report['failures'] = failures
+    write_report(report, args.output)
+    if failures:
+        print("\n".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+# Benchmarks the pp calculators and beatmap loading without touching the network.
+# Beatmap metadata is served from the corpus and files are read from a temporary storage directory.
+#
+#   python -m common.benchmarks.pp_calc --output before.json
+#   python -m common.benchmarks.pp_calc --corpus ~/corpus --systems bancho --scores 2000
+from common.benchmarks.harness import measure, metadata, summarize, write_report, offline_app
+from common.benchmarks.corpus import CorpusBeatmap, synthetic_corpus, load_corpus, write_corpus, corpus_fingerprint
+
+config = offline_app().config
+
+from common.database.objects import DBScore, DBBeatmap
+from common.constants import Mods
+
+import common.repos.beatmaps as beatmaps
+import common.performance as performance
+
+from typing import Dict, List
+
+import argparse
+import tempfile
+import random
+import shutil
+import time
+
+MOD_COMBINATIONS = {
+    0: [Mods.NoMod, Mods.Hidden, Mods.HardRock, Mods.DoubleTime, Mods.Hidden | Mods.HardRock, Mods.Hidden | Mods.DoubleTime, Mods.Easy, Mods.HalfTime],
+    1: [Mods.NoMod, Mods.Hidden, Mods.HardRock, Mods.DoubleTime, Mods.Easy, Mods.HalfTime],
+    2: [Mods.NoMod, Mods.Hidden, Mods.HardRock, Mods.DoubleTime, Mods.Easy],
+    3: [Mods.NoMod, Mods.DoubleTime, Mods.HalfTime, Mods.Easy],
+}
+
+def synthetic_scores(corpus: List[CorpusBeatmap], count: int, seed: int, relax: bool = False) -> List[DBScore]:
+    rng = random.Random(seed)
+    scores = []
+    for index in range(count):
+        beatmap = corpus[index % len(corpus)]
+        mods = rng.choice(MOD_COMBINATIONS[beatmap.mode])
+        if relax:
+            mods |= Mods.Relax
+        total = beatmap.objects
+        misses = rng.choice((0, 0, 0, 1, 2, 5))
+        n50 = rng.randrange(0, max(1, total // 100))
+        n100 = rng.randrange(0, max(1, total // 20))
+        n300 = max(0, total - n100 - n50 - misses)
+        scores.append(DBScore(
+            id=index + 1,
+            server="benchmark",
+            beatmap_id=beatmap.id,
+            beatmap_md5=beatmap.md5,
+            mode=beatmap.mode,
+            mods=int(mods),
+            relax=1 if relax else 0,
+            count_300=n300,
+            count_100=n100,
+            count_50=n50,
+            count_miss=misses,
+            count_geki=0,
+            count_katu=0,
+            max_combo=rng.randrange(total // 2, total + 1),
+            accuracy=(300*n300 + 100*n100 + 50*n50) / (300*max(1, total)) * 100,
+        ))
+    return scores
+
+def synthetic_simulations(corpus: List[CorpusBeatmap], count: int, seed: int, relax: bool = False) -> List[performance.SimulatedScore]:
+    rng = random.Random(seed)
+    return [
+        performance.SimulatedScore(
+            beatmap_id=beatmap.id,
+            mode=beatmap.mode,
+            mods=int(rng.choice(MOD_COMBINATIONS[beatmap.mode]) | (Mods.Relax if relax else 0)),
+            acc=round(rng.uniform(93, 100), 2),
+            nMiss=rng.choice((0, 0, 1, 3)),
+        )
+        for beatmap in (corpus[index % len(corpus)] for index in range(count))
+    ]
+
+def _serve_corpus(corpus: Dict[int, CorpusBeatmap]):
+    def get_beatmap(beatmap_id: int, force_fetch: bool = False, session=None) -> DBBeatmap | None:
+        if not (beatmap := corpus.get(beatmap_id)):
+            return None
+        return DBBeatmap(id=beatmap.id, set_id=-1, mode=beatmap.mode, md5=beatmap.md5, status={})
+    beatmaps.get_beatmap = get_beatmap
+
+def benchmark_system(system: performance.RosuForkPerformanceSystem, corpus: List[CorpusBeatmap], scores: List[DBScore], simulations: List[performance.SimulatedScore], repeats: int) -> dict:
+    def clear_caches(_=None):
+        system.beatmap_cache.clear()
+        system.difficulty_cache.clear()
+
+    results = {
+        'get_beatmap_file': measure(lambda beatmap: beatmaps.get_beatmap_file(beatmap.id), corpus * repeats),
+        'calculate_db_score_cold': measure(system.calculate_db_score, scores, before=clear_caches),
+    }
+    for score in scores:
+        system.calculate_db_score(score)
+    results['calculate_db_score_warm'] = measure(system.calculate_db_score, scores)
+
+    clear_caches()
+    start = time.perf_counter()
+    batch = system.calculate_db_scores(scores)
+    elapsed = time.perf_counter() - start
+    results['calculate_db_scores_cold'] = {
+        **summarize([elapsed]),
+        'scores': len(scores),
+        'failed': sum(1 for result in batch if not result.ok),
+        'per_score_ms': elapsed / max(1, len(scores)) * 1000,
+    }
+
+    results['simulate_cold'] = measure(system.simulate, simulations, before=clear_caches)
+    results['simulate_warm'] = measure(system.simulate, simulations)
+    results['beatmap_cache'] = system.beatmap_cache.stats()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pp calculators and beatmap loading")
+    parser.add_argument("--corpus", help="Directory of {beatmap_id}.osu.gz files (default: synthetic corpus)")
+    parser.add_argument("--systems", default=",".join(performance.performance_systems.keys()))
+    parser.add_argument("--scores", type=int, default=500, help="Synthetic scores per system")
+    parser.add_argument("--repeats", type=int, default=5, help="Passes over the corpus for file loading")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else synthetic_corpus(seed=args.seed)
+    storage = tempfile.mkdtemp(prefix="pp-bench-")
+    config.storage = storage
+    try:
+        _serve_corpus(write_corpus(corpus, storage))
+        report = {
+            'meta': metadata(
+                corpus='synthetic' if not args.corpus else args.corpus,
+                corpus_fingerprint=corpus_fingerprint(corpus),
+                beatmaps=len(corpus),
+                scores=args.scores,
+                seed=args.seed,
+                systems={key: performance.performance_systems[key].name for key in args.systems.split(",")},
+            ),
+            'results': {},
+        }
+        for key in args.systems.split(","):
+            system = performance.performance_systems[key]
+            # Akatsuki's calculator only handles relax plays, which don't exist on mania
+            relax = key == 'akatsuki'
+            maps = [beatmap for beatmap in corpus if not relax or beatmap.mode != 3]
+            report['results'][key] = benchmark_system(
+                system,
+                maps,
+                synthetic_scores(maps, args.scores, args.seed, relax=relax),
+                synthetic_simulations(maps, args.scores, args.seed, relax=relax),
+                args.repeats,
+            )
+        write_report(report, args.output)
+    finally:
+        shutil.rmtree(storage, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
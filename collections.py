@@ -1,10 +1,13 @@
 # Credit osu alternative devs
 from common.database.objects import DBBeatmap
-from typing import List
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Set
+from dataclasses import dataclass
 
 import datetime
 import struct
 import gzip
+import zlib
+import io
 
 OA_S_PER_DAY = 8.64e4
 OA_EPOC = datetime.datetime(1899, 12, 30, 0, 0, 0, tzinfo=datetime.timezone.utc)
@@ -33,54 +36,215 @@ def format_str(s):
     return uleb128encode(len(s)) + s
 
 
+# Collections are user uploads, anything beyond these is rejected instead of allocated
+MAX_STRING_LENGTH = 64 * 1024
+MAX_COLLECTIONS = 10000
+MAX_COLLECTION_BEATMAPS = 1000000
+
+
+def uleb128decode(stream: BinaryIO) -> int:
+    result = 0
+    shift = 0
+    while True:
+        if not (byte := stream.read(1)):
+            raise ValueError("Truncated collection file")
+        result |= (byte[0] & 0x7F) << shift
+        if not byte[0] & 0x80:
+            return result
+        shift += 7
+        if shift > 63:
+            raise ValueError("Invalid uleb128 value")
+
+
+def read_str(stream: BinaryIO) -> str:
+    if (length := uleb128decode(stream)) > MAX_STRING_LENGTH:
+        raise ValueError(f"String of {length} bytes exceeds the limit of {MAX_STRING_LENGTH}")
+    data = stream.read(length)
+    if len(data) != length:
+        raise ValueError("Truncated collection file")
+    return data.decode("utf-8", errors="replace")
+
+
+def _check_count(count: int, limit: int, kind: str) -> int:
+    if not 0 <= count <= limit:
+        raise ValueError(f"Invalid {kind} count: {count}")
+    return count
+
+
+# Fixed size fields of a beatmap entry, before and after its strings
+BEATMAP_IDS = struct.Struct("<ii")
+BEATMAP_MODE_DIFF = struct.Struct("<bd")
+INT = struct.Struct("<i")
+DOUBLE = struct.Struct("<d")
+# Entries are packed into this buffer before going through the gzip stream
+WRITE_BUFFER_SIZE = 64 * 1024
+
+
+@dataclass
+class CollectionEntry:
+    collection: str
+    md5: str
+    beatmap_id: int = -1
+    set_id: int = -1
+    artist: str = ""
+    title: str = ""
+    version: str = ""
+    comment: str = ""
+    mode: int = 0
+    diff: float = 0.0
+    # Entries osu! only knows the md5 of, without any metadata
+    hash_only: bool = False
+
+
+class CollectionReader:
+    # Lazily parses an o!dm8 file, entries are only decoded as they're iterated
+
+    def __init__(self, fileobj: BinaryIO) -> None:
+        if (version := read_str(fileobj)) != "o!dm8":
+            raise ValueError(f"Unsupported collection format: {version}")
+        self.stream = io.BufferedReader(gzip.GzipFile(filename="", mode="rb", fileobj=fileobj))
+        try:
+            if (version := read_str(self.stream)) != "o!dm8":
+                raise ValueError(f"Unsupported collection format: {version}")
+            self.date = self._unpack(DOUBLE)[0]
+            self.editor = read_str(self.stream)
+            self.collection_count = _check_count(self._unpack(INT)[0], MAX_COLLECTIONS, "collection")
+        except (OSError, EOFError, zlib.error) as e:
+            raise ValueError(f"Corrupted collection file ({e})") from e
+
+    def _unpack(self, layout: struct.Struct) -> tuple:
+        data = self.stream.read(layout.size)
+        if len(data) != layout.size:
+            raise ValueError("Truncated collection file")
+        return layout.unpack(data)
+
+    def __iter__(self) -> Iterator[CollectionEntry]:
+        try:
+            yield from self._entries()
+        except (OSError, EOFError, zlib.error) as e:
+            # Broken gzip data, reported like every other malformed file
+            raise ValueError(f"Corrupted collection file ({e})") from e
+
+    def _entries(self) -> Iterator[CollectionEntry]:
+        for _ in range(self.collection_count):
+            name = read_str(self.stream)
+            self._unpack(INT) # online ID
+            for _ in range(_check_count(self._unpack(INT)[0], MAX_COLLECTION_BEATMAPS, "beatmap")):
+                beatmap_id, set_id = self._unpack(BEATMAP_IDS)
+                artist = read_str(self.stream)
+                title = read_str(self.stream)
+                version = read_str(self.stream)
+                md5 = read_str(self.stream)
+                comment = read_str(self.stream)
+                mode, diff = self._unpack(BEATMAP_MODE_DIFF)
+                yield CollectionEntry(name, md5, beatmap_id, set_id, artist, title, version, comment, mode, diff)
+            for _ in range(_check_count(self._unpack(INT)[0], MAX_COLLECTION_BEATMAPS, "beatmap")):
+                yield CollectionEntry(name, read_str(self.stream), hash_only=True)
+
+    def md5s(self) -> Set[str]:
+        return {entry.md5 for entry in self}
+
+    def collections(self) -> Dict[str, List[CollectionEntry]]:
+        collections = {}
+        for entry in self:
+            collections.setdefault(entry.collection, []).append(entry)
+        return collections
+
+
+class CollectionWriter:
+    # Streams an o!dm8 file into any writable file object. The format stores counts
+    # before the entries, so they have to be known up front.
+
+    def __init__(self, fileobj: BinaryIO, collection_count: int, editor: str = "N/A", compresslevel: int = 9) -> None:
+        fileobj.write(format_str("o!dm8"))
+        self.stream = gzip.GzipFile(filename="", mode="wb", fileobj=fileobj, compresslevel=compresslevel)
+        self.buffer = bytearray()
+        self.collections_left = collection_count
+        self.beatmaps_left = 0
+        self.hashes: List[str] = []
+        self.in_collection = False
+        self.buffer += format_str("o!dm8")
+        self.buffer += DOUBLE.pack(OADoubleNow())
+        self.buffer += format_str(editor)
+        self.buffer += INT.pack(collection_count)
+
+    def begin_collection(self, name: str, beatmap_count: int, online_id: int = -1, hashes: Iterable[str] = ()):
+        # Hashes are md5s without any metadata, written after the beatmaps
+        self._end_collection()
+        self.hashes = list(hashes)
+        if self.collections_left <= 0:
+            raise ValueError("More collections than declared")
+        self.collections_left -= 1
+        self.beatmaps_left = beatmap_count
+        self.in_collection = True
+        self.buffer += format_str(name)
+        self.buffer += INT.pack(online_id)
+        self.buffer += INT.pack(beatmap_count)
+
+    def add(self, beatmap_id: int, set_id: int, artist: str, title: str, version: str, md5: str, mode: int, diff: float, comment: str = ""):
+        if self.beatmaps_left <= 0:
+            raise ValueError("More beatmaps than declared")
+        self.beatmaps_left -= 1
+        buffer = self.buffer
+        buffer += BEATMAP_IDS.pack(beatmap_id, set_id)
+        buffer += format_str(artist or "")
+        buffer += format_str(title or "")
+        buffer += format_str(version or "")
+        buffer += format_str(md5 or "")
+        buffer += format_str(comment or "")
+        buffer += BEATMAP_MODE_DIFF.pack(mode, diff or 0.0)
+        if len(buffer) >= WRITE_BUFFER_SIZE:
+            self._flush()
+
+    def add_beatmap(self, beatmap: DBBeatmap):
+        self.add(beatmap.id, beatmap.set_id, beatmap.beatmapset.artist, beatmap.beatmapset.title, beatmap.version, beatmap.md5, beatmap.mode, beatmap.diff)
+
+    def add_dict(self, beatmap: dict):
+        self.add(beatmap['id'], beatmap['set_id'], beatmap['artist'], beatmap['title'], beatmap['version'], beatmap['md5'], beatmap['mode'], beatmap['diff'])
+
+    def _end_collection(self):
+        if not self.in_collection:
+            return
+        if self.beatmaps_left:
+            raise ValueError(f"{self.beatmaps_left} beatmaps missing from collection")
+        self.buffer += INT.pack(len(self.hashes))
+        for md5 in self.hashes:
+            self.buffer += format_str(md5)
+        self.in_collection = False
+
+    def _flush(self):
+        self.stream.write(self.buffer)
+        self.buffer.clear()
+
+    def close(self):
+        self._end_collection()
+        if self.collections_left:
+            raise ValueError(f"{self.collections_left} collections missing")
+        self.buffer += format_str("By Piotrekol")
+        self._flush()
+        # Only finishes the gzip stream, the file object belongs to the caller
+        self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
 def generate_collection_from_db(beatmaps: List[DBBeatmap], collection_name):
-    temp_bytes = format_str("o!dm8")
-    temp_bytes += struct.pack("d", OADoubleNow())
-    temp_bytes += format_str("N/A")
-    temp_bytes += struct.pack("i", 1)
-
-    temp_bytes += format_str(collection_name)
-    temp_bytes += struct.pack("i", -1)  # online ID
-    temp_bytes += struct.pack("i", len(beatmaps))  # amount of beatmaps
-
-    for beatmap in beatmaps:
-        temp_bytes += struct.pack("i", beatmap.id)
-        temp_bytes += struct.pack("i", beatmap.set_id)
-        temp_bytes += format_str(beatmap.beatmapset.artist)
-        temp_bytes += format_str(beatmap.beatmapset.title)
-        temp_bytes += format_str(beatmap.version)
-        temp_bytes += format_str(beatmap.md5)
-        temp_bytes += format_str("")
-        temp_bytes += struct.pack("b", beatmap.mode)
-        temp_bytes += struct.pack("d", beatmap.diff)
-
-    temp_bytes += struct.pack("i", 0)
-    temp_bytes += format_str("By Piotrekol")
-        
-    return format_str("o!dm8") + gzip.compress(temp_bytes)
+    output = io.BytesIO()
+    with CollectionWriter(output, 1) as writer:
+        writer.begin_collection(collection_name, len(beatmaps))
+        for beatmap in beatmaps:
+            writer.add_beatmap(beatmap)
+    return output.getvalue()
 
 def generate_collection_from_dict(beatmaps: List[dict], collection_name):
-    temp_bytes = format_str("o!dm8")
-    temp_bytes += struct.pack("d", OADoubleNow())
-    temp_bytes += format_str("N/A")
-    temp_bytes += struct.pack("i", 1)
-
-    temp_bytes += format_str(collection_name)
-    temp_bytes += struct.pack("i", -1)  # online ID
-    temp_bytes += struct.pack("i", len(beatmaps))  # amount of beatmaps
-
-    for beatmap in beatmaps:
-        temp_bytes += struct.pack("i", beatmap['id'])
-        temp_bytes += struct.pack("i", beatmap['set_id'])
-        temp_bytes += format_str(beatmap['artist'])
-        temp_bytes += format_str(beatmap['title'])
-        temp_bytes += format_str(beatmap['version'])
-        temp_bytes += format_str(beatmap['md5'])
-        temp_bytes += format_str("")
-        temp_bytes += struct.pack("b", beatmap['mode'])
-        temp_bytes += struct.pack("d", beatmap['diff'])
-
-    temp_bytes += struct.pack("i", 0)
-    temp_bytes += format_str("By Piotrekol")
-    
-    return format_str("o!dm8") + gzip.compress(temp_bytes)
\ No newline at end of file
+    output = io.BytesIO()
+    with CollectionWriter(output, 1) as writer:
+        writer.begin_collection(collection_name, len(beatmaps))
+        for beatmap in beatmaps:
+            writer.add_dict(beatmap)
+    return output.getvalue()
@@ -30,6 +30,8 @@ class Mods(IntFlag):
     KeyMod = Key4 | Key5 | Key6 | Key7 | Key8
     SpeedMods = DoubleTime | HalfTime| Nightcore
     FreeModAllowed = NoFail | Easy | Hidden | HardRock | SuddenDeath | Flashlight | FadeIn | Relax | Autopilot | SpunOut | KeyMod
+    # NoVideo is TouchDevice in osu!, which nerfs aim difficulty
+    DifficultyMods = NoVideo | Easy | Hidden | HardRock | DoubleTime | Relax | HalfTime | Nightcore | Flashlight | SpunOut | Autopilot | KeyMod
 
     @property
     def members(self) -> list:
@@ -68,7 +70,8 @@ class Mods(IntFlag):
                 Mods.SpeedMods: "",
                 Mods.KeyMod: "",
                 Mods.LastMod: "",
-                Mods.FreeModAllowed: ""
+                Mods.FreeModAllowed: "",
+                Mods.DifficultyMods: ""
             }[mod]
             for mod in self.members
         ])
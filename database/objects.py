@@ -90,6 +90,19 @@ class DBBeatmap(Base):
     def get_total_hits(self):
         return self.count_circles + self.count_sliders + self.count_spinners
 
+class DBPerformanceCurve(Base):
+    
+    __tablename__ = 'performance_curves'
+    
+    beatmap_id = Column('beatmap_id', Integer, primary_key=True)
+    mode = Column('mode', SmallInteger, primary_key=True)
+    mods = Column('mods', Integer, primary_key=True)
+    pp_system = Column('pp_system', String, primary_key=True)
+    md5 = Column('md5', String)
+    accuracy = Column('accuracy', ARRAY(Float)) # pp at full combo for each step of the accuracy grid
+    misses = Column('misses', ARRAY(Float)) # pp for 0..N misses with every other object a 300
+    last_updated = Column('last_updated', DateTime(timezone=True), server_default=func.now())
+
 class DBUser(Base):
     
     __tablename__ = 'users'
@@ -273,10 +286,24 @@ class DBScore(Base):
     extra_metadata = Column('extra_metadata', JSONB)
 
     beatmap = relationship('DBBeatmap', back_populates='scores')
+    # Recalculations page through scores ordered by (server, id), the primary key is (id, server)
+    __table_args__ = (Index('scores_server_id', server, id), {})
 
     def get_total_hits(self):
         return self.count_300 + self.count_100 + self.count_50 + self.count_miss
 
+class DBRecalculationCheckpoint(Base):
+    
+    __tablename__ = 'recalculation_checkpoints'
+    
+    name = Column('name', String, primary_key=True)
+    pp_system = Column('pp_system', String)
+    server = Column('server', String)
+    score_id = Column('score_id', BigInteger)
+    processed = Column('processed', BigInteger)
+    completed = Column('completed', Boolean)
+    last_updated = Column('last_updated', DateTime)
+
 class DBFirstPlace(Base):
     
     __tablename__ = 'first_places'
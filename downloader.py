@@ -0,0 +1,131 @@
+from common.utils import BEATMAP_MIRRORS, FAILED_DOWNLOAD_TTL, _fetch_beatmap, _save_beatmap, beatmap_failed, mark_beatmap_failed
+from common.database.objects import DBBeatmap
+from common.beatmap_store import beatmap_store
+from common.logging import get_logger
+from common.app import database
+
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, Iterable, List, Tuple
+from dataclasses import dataclass
+from requests.adapters import HTTPAdapter
+
+import common.app as app
+import threading
+import requests
+import hashlib
+import time
+
+logger = get_logger("downloader")
+
+# Weight of the latest request in the moving averages
+EWMA_ALPHA = 0.2
+# A failing mirror counts as this many seconds slower per unit of error rate
+ERROR_PENALTY = 10.0
+
+@dataclass
+class MirrorStats:
+    name: str
+    latency: float | None = None
+    error_rate: float = 0.0
+    requests: int = 0
+    failures: int = 0
+
+    def record(self, elapsed: float, ok: bool):
+        self.requests += 1
+        if not ok:
+            self.failures += 1
+        self.error_rate += EWMA_ALPHA * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.latency = elapsed if self.latency is None else self.latency + EWMA_ALPHA * (elapsed - self.latency)
+
+    @property
+    def score(self) -> float:
+        # Untried mirrors get a chance first, in their configured order
+        return (self.latency or 0.0) + self.error_rate * ERROR_PENALTY
+
+class BeatmapDownloader:
+
+    def __init__(self, workers: int = 8, mirrors: List[str] | None = None) -> None:
+        self.workers = workers
+        self.mirrors = {name: MirrorStats(name) for name in (mirrors or BEATMAP_MIRRORS.keys())}
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=len(self.mirrors), pool_maxsize=workers)
+        self.http.mount("https://", adapter)
+        self.http.mount("http://", adapter)
+        self._lock = threading.Lock()
+
+    def ordered_mirrors(self) -> List[str]:
+        with self._lock:
+            return [stats.name for stats in sorted(self.mirrors.values(), key=lambda stats: stats.score)]
+
+    def _record(self, mirror: str, elapsed: float, ok: bool):
+        with self._lock:
+            self.mirrors[mirror].record(elapsed, ok)
+
+    def download(self, beatmap_id: int, md5: str | None = None, force: bool = False) -> bool:
+        if not force and beatmap_store().exists(beatmap_id):
+            if not md5 or beatmap_store().get_hash(beatmap_id) == md5:
+                return True
+        if not force and beatmap_failed('download', beatmap_id):
+            return False
+        for mirror in self.ordered_mirrors():
+            start = time.perf_counter()
+            try:
+                content = _fetch_beatmap(mirror, beatmap_id, http=self.http)
+            except requests.RequestException as e:
+                logger.warning(f"Failed to download beatmap {beatmap_id} from {mirror} ({e})")
+                content = None
+            if not content:
+                self._record(mirror, time.perf_counter() - start, False)
+                continue
+            self._record(mirror, time.perf_counter() - start, True)
+            if md5 and hashlib.md5(content).hexdigest() != md5:
+                # Mirrors can serve outdated versions, that's not the mirror failing
+                logger.warning(f"{mirror} has an outdated version of beatmap {beatmap_id}")
+                continue
+            _save_beatmap(beatmap_id, content)
+            return True
+        mark_beatmap_failed('download', beatmap_id, ttl=FAILED_DOWNLOAD_TTL)
+        return False
+
+    def download_many(self, beatmaps: Iterable[int | Tuple[int, str | None]], force: bool = False) -> Dict[int, bool]:
+        results = {}
+        # Keeps a few requests queued per worker, without materializing every id up front
+        slots = threading.BoundedSemaphore(self.workers * 4)
+        def done(beatmap_id: int, future: Future):
+            slots.release()
+            try:
+                results[beatmap_id] = future.result()
+            except:
+                logger.error(f"Failed to download beatmap {beatmap_id}", exc_info=True)
+                results[beatmap_id] = False
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="beatmap-download") as executor:
+            for item in beatmaps:
+                if app.STOPPED:
+                    break
+                beatmap_id, md5 = item if isinstance(item, tuple) else (item, None)
+                slots.acquire()
+                future = executor.submit(self.download, beatmap_id, md5, force)
+                future.add_done_callback(lambda future, beatmap_id=beatmap_id: done(beatmap_id, future))
+        return results
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {
+                name: {
+                    'latency': stats.latency,
+                    'error_rate': stats.error_rate,
+                    'requests': stats.requests,
+                    'failures': stats.failures,
+                }
+                for name, stats in self.mirrors.items()
+            }
+
+def backfill(workers: int = 8, force: bool = False) -> Dict[int, bool]:
+    downloader = BeatmapDownloader(workers=workers)
+    with database.managed_session() as session:
+        beatmaps = session.query(DBBeatmap.id, DBBeatmap.md5).execution_options(stream_results=True).yield_per(10000)
+        results = downloader.download_many(((beatmap_id, md5) for beatmap_id, md5 in beatmaps), force=force)
+    failed = sum(1 for ok in results.values() if not ok)
+    logger.info(f"Backfilled {len(results)} beatmaps ({failed} failed), mirrors: {downloader.stats()}")
+    return results
@@ -1,90 +1,215 @@
-from datetime import datetime, timedelta
-from typing import Optional
+from common.watch import wait_for_path
+
+from contextlib import contextmanager
+from typing import Optional, Tuple
 from pathlib import Path
+import tempfile
 import hashlib
-import asyncio
+import fcntl
+import argparse
 import json
 import gzip
-import time
+import zlib
+import os
+
+# Files written with anything but gzip start with this, followed by the codec id and level.
+# Gzip files are recognized by their own magic, so existing files keep working.
+CODEC_MAGIC = b"KCF"
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+class Codec:
+    name = ""
+    id = 0
+
+    def __init__(self, level: int = 0) -> None:
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+    def encode(self, data: bytes) -> bytes:
+        return CODEC_MAGIC + bytes((self.id, self.level)) + self.compress(data)
+
+    def __repr__(self) -> str:
+        return f"{self.name}:{self.level}"
+
+
+class RawCodec(Codec):
+    name = "raw"
+    id = 0
+
+
+class ZlibCodec(Codec):
+    name = "zlib"
+    id = 1
+
+    def __init__(self, level: int = 1) -> None:
+        super().__init__(level)
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class GzipCodec(Codec):
+    name = "gzip"
+    id = 2
+
+    def __init__(self, level: int = 9) -> None:
+        super().__init__(level)
+
+    def compress(self, data: bytes) -> bytes:
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def decompress(self, data: bytes) -> bytes:
+        return gzip.decompress(data)
+
+    def encode(self, data: bytes) -> bytes:
+        return self.compress(data)
+
+
+CODECS = {codec.name: codec for codec in (RawCodec, ZlibCodec, GzipCodec)}
+CODECS_BY_ID = {codec.id: codec for codec in CODECS.values()}
+default_codec: Codec = GzipCodec()
+
+def get_codec(spec: str | Codec | None) -> Codec:
+    # "gzip", "gzip:6", "zlib:1", "raw"
+    if spec is None:
+        return default_codec
+    if isinstance(spec, Codec):
+        return spec
+    name, _, level = spec.partition(":")
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec: {name}")
+    return CODECS[name](int(level)) if level else CODECS[name]()
+
+def detect_codec(blob: bytes) -> Codec:
+    # The level of gzip files is unknown, they're reported with the default one
+    if blob[:2] == GZIP_MAGIC:
+        return GzipCodec()
+    if blob[:3] == CODEC_MAGIC and len(blob) >= 5 and blob[3] in CODECS_BY_ID:
+        return CODECS_BY_ID[blob[3]](blob[4])
+    raise ValueError("Unknown file format")
+
+def decode(blob: bytes) -> bytes:
+    codec = detect_codec(blob)
+    return codec.decompress(blob if isinstance(codec, GzipCodec) else blob[5:])
 
 
 class DataFile:
-    def __init__(self, filepath) -> None:
+    def __init__(self, filepath, codec: str | Codec | None = None) -> None:
         # Create parent directory
         Path([item[::-1] for item in filepath[::-1].split("/", 1)][::-1][0]).mkdir(
             parents=True, exist_ok=True
         )
         self.filepath: str = filepath
         self.data: Optional[dict] = None
+        self.codec = get_codec(codec)
+        self._lock_fd: Optional[int] = None
+        self._lock_depth = 0
+
+    def read(self) -> bytes:
+        # Files are only ever replaced atomically, so readers don't need the lock
+        with open(self.filepath, "rb") as f:
+            return decode(f.read())
 
     def load_data(self, default={}):
-        self.wait_lock()
-        self.lock()
         try:
-            with gzip.open(self.filepath, "r") as fin:
-                self.data = json.loads(fin.read().decode("utf-8"))
+            self.data = json.loads(self.read().decode("utf-8"))
         except:
             self.data = default
-        self.unlock()
 
     def save_data(self):
-        self.wait_lock()
         if not self.data:
             self.load_data()
-        self.lock()
-        with gzip.open(self.filepath, "w") as fout:
-            fout.write(json.dumps(self.data).encode("utf-8"))
-        self.unlock()
+        self._write(json.dumps(self.data).encode("utf-8"))
+
+    def _write(self, content: bytes):
+        directory, name = os.path.split(self.filepath)
+        with self.locked():
+            fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory or ".")
+            try:
+                os.fchmod(fd, 0o644)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(self.codec.encode(content))
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.filepath)
+            except:
+                Path(temp_path).unlink(missing_ok=True)
+                raise
+            _fsync_directory(directory or ".")
 
     def delete(self):
-        Path(self.filepath).unlink(missing_ok=True)
+        with self.locked():
+            Path(self.filepath).unlink(missing_ok=True)
+
+    @contextmanager
+    def locked(self):
+        self.lock()
+        try:
+            yield
+        finally:
+            self.unlock()
 
     def wait_lock(self):
-        elapsed = 0.0
-        while Path(f"{self.filepath}.lock").exists():
-            time.sleep(0.1)
-            elapsed += 0.1
-            if elapsed > 30:  # Most likely a dead lock
-                self.unlock()
+        # Kept for compatibility, lock() blocks until the lock is free
+        pass
 
     def lock(self):
-        Path(f"{self.filepath}.lock").touch(exist_ok=True)
+        # Reentrant, so callers can hold the lock around a read-modify-write of their own
+        self._lock_depth += 1
+        if self._lock_fd is not None:
+            return
+        lock_path = f"{self.filepath}.lock"
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                # The previous holder may have removed the lock file while we were waiting
+                if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                    self._lock_fd = fd
+                    return
+            except FileNotFoundError:
+                pass
+            os.close(fd)
 
     def unlock(self):
+        if self._lock_fd is None:
+            return
+        self._lock_depth -= 1
+        if self._lock_depth > 0:
+            return
+        # Removed before unlocking, so lock files don't pile up next to every file
         Path(f"{self.filepath}.lock").unlink(missing_ok=True)
+        fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        os.close(self._lock_fd)
+        self._lock_fd = None
 
     def exists(self):
         return exists(self.filepath)
 
     async def wait_till_exist(self, timeout=60):
-        time = datetime.now()
-        while True:
-            if exists(self.filepath):
-                return True
-            if (datetime.now() - time) > timedelta(seconds=timeout):
-                return False
-            await asyncio.sleep(delay=1)
+        return await wait_for_path(self.filepath, timeout)
 
 
 class BinaryFile(DataFile):
     def load_data(self):
-        self.wait_lock()
-        self.lock()
         try:
-            with gzip.open(self.filepath, "r") as fin:
-                self.data = fin.read()
+            self.data = self.read()
         except:
             self.data = None
-        self.unlock()
 
     def save_data(self):
-        self.wait_lock()
         if not self.data:
             self.load_data()
-        self.lock()
-        with gzip.open(self.filepath, "w") as fout:
-            fout.write(self.data)
-        self.unlock()
+        self._write(self.data)
 
     def get_hash(self) -> str:
         if not self.data:
@@ -93,5 +218,229 @@ class BinaryFile(DataFile):
                 return None
         return hashlib.md5(self.data).hexdigest()
 
+class JournalDict(dict):
+    # Remembers which top-level keys changed since the last save. Nested values aren't
+    # watched, reassign the key (or call mark_dirty) after changing them in place.
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.changes: dict = {}
+        self.cleared = False
+
+    def mark_dirty(self, key):
+        self.changes[key] = True
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.changes[key] = True
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.changes[key] = False
+
+    def pop(self, key, *default):
+        if key in self:
+            self.changes[key] = False
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.changes[key] = False
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def clear(self):
+        super().clear()
+        self.changes.clear()
+        self.cleared = True
+
+    def records(self) -> list:
+        records = [{'c': True}] if self.cleared else []
+        for key, present in self.changes.items():
+            records.append({'k': key, 'v': self[key]} if present else {'k': key, 'd': True})
+        return records
+
+    def reset(self):
+        self.changes.clear()
+        self.cleared = False
+
+
+class JournalFile(DataFile):
+    # Saves only append the changed keys to {path}.journal. Loads replay the journal over the
+    # snapshot, which is rewritten once the journal outgrows it.
+    def __init__(self, filepath, compact_bytes: int = 1024 * 1024, codec: str | Codec | None = None) -> None:
+        super().__init__(filepath, codec)
+        self.journal_path = f"{filepath}.journal"
+        self.compact_bytes = compact_bytes
+        self.data: Optional[JournalDict] = None
+        self._journal_damaged = False
+
+    def load_data(self, default={}):
+        # Readers don't lock. Compaction rewrites the snapshot and then swaps in a new journal,
+        # so a journal other than the one that existed before reading the snapshot may belong
+        # to a newer snapshot than the one read, and everything is read again.
+        while True:
+            journal_inode = self._journal_inode()
+            super().load_data(default)
+            records, inode = self._read_journal()
+            if inode == journal_inode:
+                break
+        data = JournalDict(self.data)
+        for record in records:
+            _apply_record(data, record)
+        data.reset()
+        self.data = data
+
+    def _journal_inode(self) -> int | None:
+        try:
+            return os.stat(self.journal_path).st_ino
+        except FileNotFoundError:
+            return None
+
+    def _read_journal(self) -> Tuple[list, int | None]:
+        records = []
+        try:
+            f = open(self.journal_path, "rb")
+        except FileNotFoundError:
+            return records, None
+        with f:
+            inode = os.fstat(f.fileno()).st_ino
+            try:
+                with gzip.open(f, "rt", encoding="utf-8") as journal:
+                    for line in journal:
+                        if not line.endswith("\n"):
+                            break
+                        records.append(json.loads(line))
+            except (EOFError, OSError, ValueError):
+                # A crash mid-append leaves a truncated record, everything before it is intact
+                self._journal_damaged = True
+        return records, inode
+
+    def save_data(self):
+        if self.data is None:
+            self.load_data()
+        if not isinstance(self.data, JournalDict):
+            # Replaced wholesale by the caller, nothing to diff against
+            data = JournalDict()
+            data.clear()
+            data.update(self.data)
+            self.data = data
+        if not (records := self.data.records()):
+            return
+        content = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        with self.locked():
+            if self._journal_damaged:
+                # Anything appended after a damaged record would never be read back
+                self.compact()
+                return
+            with open(self.journal_path, "ab") as f:
+                f.write(gzip.compress(content))
+                f.flush()
+                os.fsync(f.fileno())
+            self.data.reset()
+            if os.path.getsize(self.journal_path) > max(self.compact_bytes, self._snapshot_size()):
+                self.compact()
+
+    def _snapshot_size(self) -> int:
+        try:
+            return os.path.getsize(self.filepath)
+        except FileNotFoundError:
+            return 0
+
+    def compact(self):
+        with self.locked():
+            # Other writers may have appended since we loaded, so the snapshot is built from disk
+            pending = self.data.records() if isinstance(self.data, JournalDict) else []
+            self.load_data()
+            self._write(json.dumps(self.data).encode("utf-8"))
+            # Replaying the old journal over the new snapshot gives the same result, so a crash
+            # before the swap loses nothing. Unsaved changes start the new journal.
+            self._replace_journal(pending)
+            for record in pending:
+                _apply_record(self.data, record)
+            self.data.reset()
+            self._journal_damaged = False
+
+    def _replace_journal(self, records: list):
+        directory, name = os.path.split(self.journal_path)
+        fd, temp_path = tempfile.mkstemp(prefix=f".{name}.", suffix=".tmp", dir=directory or ".")
+        try:
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, "wb") as f:
+                if records:
+                    f.write(gzip.compress("".join(json.dumps(record) + "\n" for record in records).encode("utf-8")))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.journal_path)
+        except:
+            Path(temp_path).unlink(missing_ok=True)
+            raise
+        _fsync_directory(directory or ".")
+
+    def delete(self):
+        with self.locked():
+            Path(self.journal_path).unlink(missing_ok=True)
+            Path(self.filepath).unlink(missing_ok=True)
+
+def _apply_record(data: dict, record: dict):
+    if record.get('c'):
+        dict.clear(data)
+    elif record.get('d'):
+        dict.pop(data, record['k'], None)
+    else:
+        dict.__setitem__(data, record['k'], record['v'])
+
+def _fsync_directory(directory: str):
+    # Makes the rename itself survive a crash
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 def exists(filepath):
     return Path(filepath).exists()
+
+def migrate(directory: str, codec: str | Codec, pattern: str = "*.gz", force: bool = False) -> Tuple[int, int]:
+    codec = get_codec(codec)
+    migrated = skipped = 0
+    for path in sorted(Path(directory).rglob(pattern)):
+        with open(path, "rb") as f:
+            header = f.read(5)
+        try:
+            current = detect_codec(header)
+        except ValueError:
+            skipped += 1
+            continue
+        # Gzip doesn't record its level, so those files are only rewritten when switching codecs
+        if not force and current.id == codec.id and (isinstance(codec, GzipCodec) or current.level == codec.level):
+            continue
+        file = BinaryFile(str(path), codec=codec)
+        file.load_data()
+        if file.data is None:
+            skipped += 1
+            continue
+        file.save_data()
+        migrated += 1
+    return migrated, skipped
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite stored files with another codec")
+    parser.add_argument("directory")
+    parser.add_argument("--codec", required=True, help="raw, zlib[:level] or gzip[:level]")
+    parser.add_argument("--pattern", default="*.gz", help="Glob of the files to migrate")
+    parser.add_argument("--force", action="store_true", help="Rewrite files already using the codec, e.g. to change the gzip level")
+    args = parser.parse_args()
+    migrated, skipped = migrate(args.directory, args.codec, args.pattern, args.force)
+    print(f"Migrated {migrated} files to {get_codec(args.codec)} ({skipped} unreadable files skipped)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+# Imports beatmaps from local .osu files instead of fetching every set over the osu! API.
+# Accepts a directory, a tarball (e.g. the osu_files archive from data.ppy.sh) or a zip/.osz.
+# Importing the same files again doesn't change anything, existing rows are left untouched.
+#
+#   python -m common.importer ~/osu_files.tar.bz2 --workers 16
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from common.database.objects import DBBeatmap, DBBeatmapset
+from common.logging import get_logger
+from common.app import database
+
+from sqlalchemy.dialects.postgresql import insert
+
+from typing import Dict, Iterator, List, Tuple
+from dataclasses import dataclass
+from pathlib import Path
+
+import common.app as app
+import multiprocessing
+import argparse
+import tarfile
+import zipfile
+import hashlib
+import time
+import os
+
+logger = get_logger("importer")
+
+INSERT_BATCH_SIZE = 1000
+
+@dataclass
+class ImportProgress:
+    files: int = 0
+    imported: int = 0
+    skipped: int = 0
+    failed: int = 0
+    beatmapsets: int = 0
+    elapsed: float = 0.0
+
+    def __repr__(self) -> str:
+        return f"{self.files} files, {self.imported} beatmaps in {self.beatmapsets} sets imported, {self.skipped} skipped, {self.failed} failed, {self.elapsed:.0f}s elapsed"
+
+@dataclass
+class ParsedBeatmap:
+    beatmap: dict
+    beatmapset: dict
+
+def _sections(text: str) -> Tuple[Dict[str, Dict[str, str]], Dict[str, List[str]]]:
+    values = {}
+    lists = {}
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("//"):
+            continue
+        if line.startswith("[") and line.endswith("]"):
+            section = line[1:-1]
+            continue
+        if section in ("General", "Metadata", "Difficulty"):
+            key, _, value = line.partition(":")
+            values.setdefault(section, {})[key.strip()] = value.strip()
+        elif section in ("Events", "TimingPoints", "HitObjects"):
+            lists.setdefault(section, []).append(line)
+    return values, lists
+
+def _bpm(timing_points: List[str], last_time: float) -> float | None:
+    # The bpm that lasts the longest, like the website shows it
+    points = []
+    for line in timing_points:
+        parts = line.split(",")
+        if len(parts) < 2:
+            continue
+        uninherited = parts[6] != "0" if len(parts) > 6 else True
+        if uninherited and float(parts[1]) > 0:
+            points.append((float(parts[0]), 60000 / float(parts[1])))
+    if not points:
+        return None
+    durations = {}
+    for index, (start, bpm) in enumerate(points):
+        end = points[index + 1][0] if index + 1 < len(points) else max(last_time, start)
+        durations[round(bpm, 3)] = durations.get(round(bpm, 3), 0) + max(0, end - start)
+    return max(durations, key=durations.get)
+
+def parse_osu(data: bytes, beatmap_id: int | None = None) -> ParsedBeatmap | None:
+    values, lists = _sections(data.decode("utf-8-sig", errors="ignore"))
+    general = values.get("General", {})
+    metadata = values.get("Metadata", {})
+    difficulty = values.get("Difficulty", {})
+    # Old files don't have ids in their metadata, dumps name them {beatmap_id}.osu instead
+    beatmap_id = int(metadata.get("BeatmapID", 0) or 0) or beatmap_id
+    set_id = int(metadata.get("BeatmapSetID", 0) or 0)
+    if not beatmap_id or beatmap_id <= 0 or set_id <= 0:
+        return None
+
+    mode = int(general.get("Mode", 0) or 0)
+    circles = sliders = spinners = 0
+    first_time = last_time = None
+    for line in lists.get("HitObjects", []):
+        parts = line.split(",")
+        if len(parts) < 4:
+            continue
+        start = end = int(float(parts[2]))
+        kind = int(parts[3])
+        if kind & 1:
+            circles += 1
+        elif kind & 2:
+            sliders += 1
+        elif kind & 8:
+            spinners += 1
+            end = int(float(parts[5])) if len(parts) > 5 else start
+        elif kind & 128:
+            # Mania holds count as sliders on the website
+            sliders += 1
+            end = int(float(parts[5].split(":")[0])) if len(parts) > 5 else start
+        first_time = start if first_time is None else min(first_time, start)
+        last_time = end if last_time is None else max(last_time, end)
+    if first_time is None:
+        return None
+    breaks = 0
+    for line in lists.get("Events", []):
+        parts = line.split(",")
+        if parts[0] in ("2", "Break") and len(parts) >= 3:
+            breaks += int(float(parts[2])) - int(float(parts[1]))
+
+    def value(section: dict, key: str, default: float | None = None) -> float | None:
+        try:
+            return float(section[key])
+        except (KeyError, ValueError):
+            return default
+
+    od = value(difficulty, "OverallDifficulty", 5.0)
+    return ParsedBeatmap(
+        beatmap=dict(
+            id=beatmap_id,
+            set_id=set_id,
+            mode=mode,
+            md5=hashlib.md5(data).hexdigest(),
+            version=metadata.get("Version"),
+            bpm=_bpm(lists.get("TimingPoints", []), last_time),
+            cs=value(difficulty, "CircleSize", 5.0),
+            od=od,
+            # Files from before AR existed use OD for both
+            ar=value(difficulty, "ApproachRate", od),
+            hp=value(difficulty, "HPDrainRate", 5.0),
+            total_length=last_time // 1000,
+            hit_length=max(0, last_time - first_time - breaks) // 1000,
+            count_circles=circles,
+            count_sliders=sliders,
+            count_spinners=spinners,
+        ),
+        beatmapset=dict(
+            id=set_id,
+            artist=metadata.get("Artist"),
+            artist_unicode=metadata.get("ArtistUnicode") or metadata.get("Artist"),
+            title=metadata.get("Title"),
+            title_unicode=metadata.get("TitleUnicode") or metadata.get("Title"),
+            source=metadata.get("Source"),
+            mapper=metadata.get("Creator"),
+            tags=metadata.get("Tags", "").split(),
+        ),
+    )
+
+def _difficulty(data: bytes, mode: int) -> Tuple[float | None, int | None]:
+    from common.performance import performance_systems
+    system = performance_systems['bancho']
+    try:
+        attributes = system.calculator_class(mode=mode).difficulty(system.beatmap_class(bytes=data))
+        return attributes.stars, attributes.max_combo
+    except:
+        logger.warning("Failed to calculate difficulty", exc_info=True)
+        return None, None
+
+def _import_file(name: str, data: bytes) -> ParsedBeatmap | None:
+    # Imported here so the process pool workers only load what they need
+    from common.beatmap_store import beatmap_store
+    from common.utils import _save_beatmap
+
+    stem = Path(name).name.split(".")[0]
+    if not (parsed := parse_osu(data, int(stem) if stem.isdigit() else None)):
+        return None
+    beatmap = parsed.beatmap
+    beatmap['diff'], beatmap['max_combo'] = _difficulty(data, beatmap['mode'])
+    if beatmap_store().get_hash(beatmap['id']) != beatmap['md5']:
+        _save_beatmap(beatmap['id'], data)
+    return parsed
+
+def iter_files(path: str) -> Iterator[Tuple[str, bytes]]:
+    if os.path.isdir(path):
+        for file in sorted(Path(path).rglob("*.osu")):
+            yield str(file), file.read_bytes()
+    elif zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as archive:
+            for name in archive.namelist():
+                if name.endswith(".osu"):
+                    yield name, archive.read(name)
+    else:
+        # Streamed, so compressed dumps are never extracted to disk
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if member.isfile() and member.name.endswith(".osu"):
+                    yield member.name, archive.extractfile(member).read()
+
+def _insert(beatmapsets: Dict[int, dict], beatmaps: List[dict]) -> Tuple[int, List[int]]:
+    if not beatmaps:
+        return 0, []
+    with database.managed_session() as session:
+        sets = session.execute(
+            insert(DBBeatmapset)
+            .values([{**beatmapset, 'nominators': {}} for beatmapset in beatmapsets.values()])
+            .on_conflict_do_nothing(index_elements=[DBBeatmapset.id])
+        ).rowcount
+        inserted = session.execute(
+            insert(DBBeatmap)
+            .values(beatmaps)
+            .on_conflict_do_nothing(index_elements=[DBBeatmap.id])
+            .returning(DBBeatmap.id)
+        ).scalars().all()
+        session.commit()
+    return sets, inserted
+
+def import_beatmaps(path: str, workers: int | None = None, resolve_statuses: bool = True) -> ImportProgress:
+    # Not imported at the top, the process pool workers would load every server API otherwise
+    from common.repos.beatmaps import status_resolver
+    import common.servers as servers
+
+    progress = ImportProgress()
+    workers = workers or os.cpu_count() or 1
+    beatmapsets: Dict[int, dict] = {}
+    beatmaps: List[dict] = []
+    imported_ids = []
+    start = time.time()
+    last_report = 0.0
+
+    def flush():
+        sets, inserted = _insert(beatmapsets, beatmaps)
+        progress.beatmapsets += sets
+        progress.imported += len(inserted)
+        progress.skipped += len(beatmaps) - len(inserted)
+        imported_ids.extend(inserted)
+        beatmapsets.clear()
+        beatmaps.clear()
+
+    def collect(future):
+        nonlocal last_report
+        try:
+            parsed = future.result()
+        except:
+            logger.error("Failed to import beatmap file", exc_info=True)
+            progress.failed += 1
+            return
+        if not parsed:
+            progress.skipped += 1
+            return
+        # Offline files don't know about any server, statuses of new maps are resolved afterwards
+        parsed.beatmap['status'] = {}
+        beatmapsets.setdefault(parsed.beatmapset['id'], parsed.beatmapset)
+        beatmaps.append(parsed.beatmap)
+        if len(beatmaps) >= INSERT_BATCH_SIZE:
+            flush()
+        progress.elapsed = time.time() - start
+        if progress.elapsed - last_report >= 30:
+            logger.info(f"Import progress: {progress}")
+            last_report = progress.elapsed
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        pending = set()
+        for name, data in iter_files(path):
+            if app.STOPPED:
+                break
+            progress.files += 1
+            pending.add(pool.submit(_import_file, name, data))
+            # Keeps memory bounded when reading large dumps faster than they're parsed
+            if len(pending) >= workers * 4:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    collect(future)
+        for future in pending:
+            collect(future)
+    flush()
+
+    if resolve_statuses and imported_ids:
+        # Only waits for the imported beatmaps, nothing else that happens to be queued
+        request = status_resolver.enqueue(imported_ids, [server.server_name for server in servers.servers])
+        logger.info("Waiting for ranked statuses...")
+        request.wait()
+        if request.failed:
+            logger.warning(f"Failed to resolve {len(request.failed)} map statuses, the status sweep retries them")
+    progress.elapsed = time.time() - start
+    logger.info(f"Import finished: {progress}")
+    return progress
+
+def main():
+    parser = argparse.ArgumentParser(description="Import beatmaps from local .osu files")
+    parser.add_argument("path", help="Directory, tarball or zip containing .osu files")
+    parser.add_argument("--workers", type=int, help="Parser processes (default: all cores)")
+    parser.add_argument("--no-status", action="store_true", help="Don't resolve ranked statuses now, running status resolvers sweep them up later")
+    args = parser.parse_args()
+    import_beatmaps(args.path, workers=args.workers, resolve_statuses=not args.no_status)
+
+if __name__ == "__main__":
+    main()
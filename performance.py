@@ -1,17 +1,24 @@
-from titanic_pp_py import Beatmap as Beatmap_titanic, Calculator as Calculator_titanic
-from akatsuki_pp_py import Beatmap as Beatmap_akat, Calculator as Calculator_akat
-from rosu_pp_py import Beatmap as Beatmap_rosu, Calculator as Calculator_rosu
-
-from common.repos.beatmaps import get_beatmap_file
-from common.database.objects import DBScore
+from common.utils import LRUCache, beatmap_update_handlers
+from common.database.objects import DBScore, DBBeatmap, DBPerformanceCurve
 from common.api.server_api import Score
+from common.constants import BeatmapStatus, Mods
 from common.logging import get_logger
 
+import common.repos.curves as curves
+
+from typing import Dict, Iterable, List, Tuple, Type
 from dataclasses import dataclass
-from typing import Dict, Type
+from bisect import bisect_right
+
+import importlib
 
 logger = get_logger("performance")
 
+# Grid of the precomputed pp curves, see RosuForkPerformanceSystem.build_curve
+CURVE_ACCURACY = [90 + step * 0.5 for step in range(21)]
+CURVE_MAX_MISSES = 10
+CURVE_STATUSES = (BeatmapStatus.Ranked, BeatmapStatus.Approved, BeatmapStatus.Loved)
+
 @dataclass
 class SimulatedScore:
     beatmap_id: int
@@ -27,6 +34,21 @@ class SimulatedScore:
     acc: float = 0
     passed_objects: int = 0
 
+@dataclass
+class PerformanceResult:
+    pp: float | None = None
+    error: str | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+@dataclass
+class ScorePerformance:
+    pp: float = 0.0
+    fc_pp: float = 0.0
+    ss_pp: float | None = None
+
 class PerformanceSystem:
     
     def __init__(self, name: str):
@@ -34,61 +56,275 @@ class PerformanceSystem:
 
     def calculate_db_score(self, score: DBScore, as_fc=False) -> float:
         return 0.0
+
+    def calculate_db_scores(self, scores: Iterable[DBScore], as_fc=False) -> List[PerformanceResult]:
+        return [PerformanceResult(pp=self.calculate_db_score(score, as_fc=as_fc)) for score in scores]
     
     def calculate_score(self, score: Score, as_fc=False) -> float:
         return 0.0
+
+    def calculate_scores(self, scores: Iterable[Score], as_fc=False) -> List[PerformanceResult]:
+        return self.calculate_db_scores([score.to_db() for score in scores], as_fc=as_fc)
+
+    def calculate_db_score_with_fc(self, score: DBScore, with_ss=False) -> ScorePerformance | None:
+        return ScorePerformance(
+            pp=self.calculate_db_score(score),
+            fc_pp=self.calculate_db_score(score, as_fc=True)
+        )
+
+    def calculate_score_with_fc(self, score: Score, with_ss=False) -> ScorePerformance | None:
+        return self.calculate_db_score_with_fc(score.to_db(), with_ss=with_ss)
     
-    def simulate(self, score: SimulatedScore) -> float:
+    def simulate(self, score: SimulatedScore, approximate=False) -> float:
         return 0.0
 
+    def invalidate_beatmap(self, beatmap_id: int):
+        pass
+
 
 class RosuForkPerformanceSystem(PerformanceSystem):
     
-    def __init__(self, name: str, beatmap_class: Type, calculator_class: Type):
-        self.beatmap_class = beatmap_class
-        self.calculator_class = calculator_class
+    def __init__(self, name: str, module: str, cache_entries: int = 512, cache_bytes: int = 256*1024*1024):
+        # The calculator extension is only imported once the system is actually used
+        self.module = module
+        self._beatmap_class: Type | None = None
+        self._calculator_class: Type | None = None
+        # Parsed beatmaps keyed by beatmap id, stored as (md5, beatmap) and sized by their .osu length
+        self.beatmap_cache = LRUCache(max_entries=cache_entries, max_bytes=cache_bytes)
+        # Difficulty attributes keyed by (md5, mode, difficulty mods). Only kept in-process, the
+        # pre-1.0 bindings can neither pickle their attributes nor construct them from stored values.
+        self.difficulty_cache = LRUCache(max_entries=cache_entries*8)
+        # Precomputed pp curves keyed by (beatmap id, mode, mods), False for known missing curves
+        self.curve_cache = LRUCache(max_entries=cache_entries*64)
         super().__init__(name)
+
+    @property
+    def beatmap_class(self) -> Type:
+        if self._beatmap_class is None:
+            self._import_module()
+        return self._beatmap_class
+
+    @property
+    def calculator_class(self) -> Type:
+        if self._calculator_class is None:
+            self._import_module()
+        return self._calculator_class
+
+    def _import_module(self):
+        module = importlib.import_module(self.module)
+        self._calculator_class = module.Calculator
+        self._beatmap_class = module.Beatmap
+
+    def _load_beatmap(self, beatmap_id: int) -> Tuple[object, str] | None:
+        # repos.beatmaps pulls in the server APIs, processes that never calculate pp shouldn't pay for it
+        from common.repos.beatmaps import get_beatmap_file, get_beatmap_hash
+        if (cached := self.beatmap_cache.get(beatmap_id)) and cached[0] == get_beatmap_hash(beatmap_id):
+            return cached[1], cached[0]
+        beatmap = get_beatmap_file(beatmap_id)
+        if beatmap is None:
+            return None
+        data, md5 = beatmap
+        # Archived maps are memoryviews, the calculators only take bytes
+        map = self.beatmap_class(bytes=bytes(data))
+        self.beatmap_cache.set(beatmap_id, (md5, map), size=len(data))
+        return map, md5
+
+    def _difficulty(self, map, md5: str, mode: int, mods: int):
+        key = (md5, mode, int(mods) & Mods.DifficultyMods)
+        if (difficulty := self.difficulty_cache.get(key)) is not None:
+            return difficulty
+        difficulty = self.calculator_class(mode=mode, mods=mods).difficulty(map)
+        self.difficulty_cache.set(key, difficulty)
+        return difficulty
+
+    def invalidate_beatmap(self, beatmap_id: int):
+        self.beatmap_cache.invalidate(beatmap_id)
+        self.curve_cache.invalidate_where(lambda key: key[0] == beatmap_id)
     
     def calculate_db_score(self, score: DBScore, as_fc=False) -> float:
         try:
-            beatmap = get_beatmap_file(score.beatmap_id)
+            beatmap = self._load_beatmap(score.beatmap_id)
             if beatmap is None:
                 logger.warn(f"Can't recalculate {score.id}! (BeatmapID: {score.beatmap_id} not found)")
                 return 0.0
             if score.beatmap_md5 != beatmap[1]:
                 logger.warn(f"Can't recalculate {score.id}! (BeatmapMD5: {score.beatmap_md5} != {beatmap[1]})")
                 return 0.0
-            map = self.beatmap_class(bytes=beatmap[0])
-            calc = self.calculator_class(
-                mode = score.mode,
-                mods = score.mods,
-                n300 = score.count_300,
-                n100 = score.count_100,
-                n50 = score.count_50,
-                n_misses = score.count_miss,
-                n_geki = score.count_geki,
-                n_katu = score.count_katu,
-                acc = score.accuracy,
-            )
-            if as_fc:
-                calc.set_n_misses(0)
-                calc.set_n300(score.count_300 + score.count_miss)
-            else:
-                calc.set_combo(score.max_combo)
+            map, md5 = beatmap
+            calc = self._score_calculator(score, as_fc)
+            calc.set_difficulty(self._difficulty(map, md5, score.mode, score.mods))
             return calc.performance(map).pp
         except:
             logger.error(f"Failed to calculate performance for score {score.id} (BeatmapID: {score.beatmap_id})", exc_info=True)
+
+    def calculate_db_score_with_fc(self, score: DBScore, with_ss=False) -> ScorePerformance | None:
+        try:
+            beatmap = self._load_beatmap(score.beatmap_id)
+            if beatmap is None:
+                logger.warn(f"Can't recalculate {score.id}! (BeatmapID: {score.beatmap_id} not found)")
+                return ScorePerformance()
+            if score.beatmap_md5 != beatmap[1]:
+                logger.warn(f"Can't recalculate {score.id}! (BeatmapMD5: {score.beatmap_md5} != {beatmap[1]})")
+                return ScorePerformance()
+            map, md5 = beatmap
+            # One parsed map and one difficulty calculation shared by every variant
+            difficulty = self._difficulty(map, md5, score.mode, score.mods)
+            result = ScorePerformance()
+            calc = self._score_calculator(score)
+            calc.set_difficulty(difficulty)
+            result.pp = calc.performance(map).pp
+            calc = self._score_calculator(score, as_fc=True)
+            calc.set_difficulty(difficulty)
+            result.fc_pp = calc.performance(map).pp
+            if with_ss:
+                calc = self.calculator_class(mode=score.mode, mods=score.mods)
+                calc.set_difficulty(difficulty)
+                result.ss_pp = calc.performance(map).pp
+            return result
+        except:
+            logger.error(f"Failed to calculate performance for score {score.id} (BeatmapID: {score.beatmap_id})", exc_info=True)
+
+    def calculate_db_scores(self, scores: Iterable[DBScore], as_fc=False) -> List[PerformanceResult]:
+        scores = list(scores)
+        results: List[PerformanceResult] = [None] * len(scores)
+        # Scores sharing beatmap, mode and mods share the same difficulty attributes
+        groups: Dict[Tuple[int, int, int], List[int]] = {}
+        for index, score in enumerate(scores):
+            groups.setdefault((score.beatmap_id, score.mode, score.mods), []).append(index)
+
+        for (beatmap_id, mode, mods), indexes in groups.items():
+            try:
+                beatmap = self._load_beatmap(beatmap_id)
+                error = f"Beatmap {beatmap_id} not found"
+            except Exception as e:
+                logger.error(f"Failed to load beatmap {beatmap_id}", exc_info=True)
+                beatmap = None
+                error = f"Failed to load beatmap {beatmap_id}: {e}"
+            if beatmap is None:
+                for index in indexes:
+                    results[index] = PerformanceResult(error=error)
+                continue
+            map, md5 = beatmap
+            difficulty = None
+            for index in indexes:
+                score = scores[index]
+                if score.beatmap_md5 != md5:
+                    results[index] = PerformanceResult(error=f"Beatmap MD5 mismatch ({score.beatmap_md5} != {md5})")
+                    continue
+                try:
+                    if difficulty is None:
+                        difficulty = self._difficulty(map, md5, mode, mods)
+                    calc = self._score_calculator(score, as_fc)
+                    calc.set_difficulty(difficulty)
+                    results[index] = PerformanceResult(pp=calc.performance(map).pp)
+                except Exception as e:
+                    logger.error(f"Failed to calculate performance for score {score.id} (BeatmapID: {score.beatmap_id})", exc_info=True)
+                    results[index] = PerformanceResult(error=str(e))
+        return results
+
+    def _score_calculator(self, score: DBScore, as_fc=False):
+        calc = self.calculator_class(
+            mode = score.mode,
+            mods = score.mods,
+            n300 = score.count_300,
+            n100 = score.count_100,
+            n50 = score.count_50,
+            n_misses = score.count_miss,
+            n_geki = score.count_geki,
+            n_katu = score.count_katu,
+            acc = score.accuracy,
+        )
+        if as_fc:
+            calc.set_n_misses(0)
+            calc.set_n300(score.count_300 + score.count_miss)
+        else:
+            calc.set_combo(score.max_combo)
+        return calc
     
     def calculate_score(self, score: Score, as_fc=False) -> float:
         return self.calculate_db_score(score.to_db(), as_fc=as_fc)
 
-    def simulate(self, score: SimulatedScore) -> float:
+    def build_curve(self, beatmap_id: int, mode: int, mods: int) -> DBPerformanceCurve | None:
+        beatmap = self._load_beatmap(beatmap_id)
+        if beatmap is None:
+            return None
+        map, md5 = beatmap
+        difficulty = self._difficulty(map, md5, mode, mods)
+        def performance(**kwargs) -> float:
+            calc = self.calculator_class(mode=mode, mods=mods, **kwargs)
+            calc.set_difficulty(difficulty)
+            return calc.performance(map).pp
+        return DBPerformanceCurve(
+            beatmap_id=beatmap_id,
+            mode=mode,
+            mods=mods,
+            pp_system=self.name,
+            md5=md5,
+            accuracy=[performance(acc=acc) for acc in CURVE_ACCURACY],
+            misses=[performance(n_misses=misses) for misses in range(CURVE_MAX_MISSES + 1)],
+        )
+
+    def precompute_curves(self, beatmaps: Iterable[DBBeatmap], mods: Iterable[int] = (0,)) -> int:
+        mods = list(mods)
+        stored = 0
+        for beatmap in beatmaps:
+            if not beatmap.status or not any(status in CURVE_STATUSES for status in beatmap.status.values()):
+                continue
+            batch = []
+            for mod in mods:
+                try:
+                    if (curve := self.build_curve(beatmap.id, beatmap.mode, mod)):
+                        batch.append(curve)
+                except:
+                    logger.error(f"Failed to build pp curve for {beatmap.id} (Mods: {mod})", exc_info=True)
+            if batch:
+                curves.store_curves(batch)
+                self.curve_cache.invalidate_where(lambda key: key[0] == beatmap.id)
+                stored += len(batch)
+        return stored
+
+    def prefetch_curves(self, beatmap_ids: Iterable[int], mode: int, mods: int):
+        beatmap_ids = list(beatmap_ids)
+        found = curves.get_curves(beatmap_ids, mode, mods, self.name)
+        for beatmap_id in beatmap_ids:
+            curve = found.get(beatmap_id, False)
+            self.curve_cache.set((beatmap_id, mode, curves.curve_mods(mods)), curve, ttl=None if curve else 600)
+
+    def _get_curve(self, beatmap_id: int, mode: int, mods: int) -> DBPerformanceCurve | None:
+        key = (beatmap_id, mode, curves.curve_mods(mods))
+        if (curve := self.curve_cache.get(key)) is None:
+            try:
+                curve = curves.get_curve(beatmap_id, mode, mods, self.name) or False
+            except:
+                logger.warning(f"Failed to read pp curve for {beatmap_id} ({self.name})", exc_info=True)
+                curve = False
+            # Missing curves are remembered for a while so tight loops don't keep querying them
+            self.curve_cache.set(key, curve, ttl=None if curve else 600)
+        if not curve:
+            return None
+        # Curves built from an older version of the map are stale until precomputed again
+        from common.repos.beatmaps import get_beatmap_hash
+        if curve.md5 != get_beatmap_hash(beatmap_id):
+            return None
+        return curve
+
+    def _simulate_from_curve(self, score: SimulatedScore) -> float | None:
+        # Exact hit counts, combo or partial plays need the real calculation
+        if any((score.n300, score.n100, score.n50, score.nGeki, score.nKatu, score.max_combo, score.passed_objects)):
+            return None
+        if not (curve := self._get_curve(score.beatmap_id, score.mode, score.mods)):
+            return None
+        return interpolate_curve(curve, score.acc or 100, score.nMiss)
+
+    def simulate(self, score: SimulatedScore, approximate=False) -> float:
+        if approximate and (pp := self._simulate_from_curve(score)) is not None:
+            return pp
         try:
-            beatmap = get_beatmap_file(score.beatmap_id)
+            beatmap = self._load_beatmap(score.beatmap_id)
             if beatmap is None:
                 logger.warn(f"Can't recalculate {score.id}! (BeatmapID: {score.beatmap_id} not found)")
                 return 0.0
-            map = self.beatmap_class(bytes=beatmap[0])
+            map, md5 = beatmap
             calc = self.calculator_class(mode = score.mode)
             for key in score.__dict__.keys():
                 match key:
@@ -122,17 +358,40 @@ class RosuForkPerformanceSystem(PerformanceSystem):
                     case "passed_objects":
                         if score.passed_objects:
                             calc.set_passed_objects(score.passed_objects)
+            # Partial plays have their own difficulty, everything else shares the cached one
+            if not score.passed_objects:
+                calc.set_difficulty(self._difficulty(map, md5, score.mode, score.mods))
             return calc.performance(map).pp
         except:
             logger.error(f"Failed to calculate performance for score {score.id} (BeatmapID: {score.beatmap_id})", exc_info=True)
 
 
+def interpolate_curve(curve: DBPerformanceCurve, acc: float, misses: int = 0) -> float | None:
+    if acc > 100 or acc < CURVE_ACCURACY[0] or misses >= len(curve.misses):
+        return None
+    index = bisect_right(CURVE_ACCURACY, acc)
+    if index >= len(CURVE_ACCURACY):
+        pp = curve.accuracy[-1]
+    else:
+        low, high = CURVE_ACCURACY[index-1], CURVE_ACCURACY[index]
+        pp = curve.accuracy[index-1] + (curve.accuracy[index] - curve.accuracy[index-1]) * (acc - low) / (high - low)
+    if misses and curve.misses[0]:
+        pp *= curve.misses[misses] / curve.misses[0]
+    return pp
+
+
 performance_systems: Dict[str, PerformanceSystem] = {
-    'akatsuki': RosuForkPerformanceSystem('akatsuki-pp-rs_0.9.6', Beatmap_akat, Calculator_akat),
-    'bancho':   RosuForkPerformanceSystem('rosu-pp-rs_0.10.0', Beatmap_rosu, Calculator_rosu),
-    'titanic':  RosuForkPerformanceSystem('titanic-pp-rs_0.0.5', Beatmap_titanic, Calculator_titanic),
+    'akatsuki': RosuForkPerformanceSystem('akatsuki-pp-rs_0.9.6', 'akatsuki_pp_py'),
+    'bancho':   RosuForkPerformanceSystem('rosu-pp-rs_0.10.0', 'rosu_pp_py'),
+    'titanic':  RosuForkPerformanceSystem('titanic-pp-rs_0.0.5', 'titanic_pp_py'),
 }
 
+def _invalidate_beatmap(beatmap_id: int):
+    for system in performance_systems.values():
+        system.invalidate_beatmap(beatmap_id)
+
+beatmap_update_handlers.append(_invalidate_beatmap)
+
 def by_version(version: str) -> PerformanceSystem | None:
     for system in performance_systems.values():
         if system.name == version:
@@ -0,0 +1,247 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from common.database.objects import DBScore, DBRecalculationCheckpoint
+from common.logging import get_logger
+from common.app import database
+
+from sqlalchemy import select, tuple_, literal, func
+
+from typing import Callable, Dict, List, Tuple
+from dataclasses import dataclass
+from datetime import datetime
+
+import common.app as app
+import multiprocessing
+import time
+import os
+
+# Everything the calculators need, loaded as plain rows instead of full ORM objects
+SCORE_COLUMNS = [
+    DBScore.id, DBScore.server, DBScore.beatmap_id, DBScore.beatmap_md5,
+    DBScore.max_combo, DBScore.count_300, DBScore.count_100, DBScore.count_50,
+    DBScore.count_miss, DBScore.count_katu, DBScore.count_geki, DBScore.accuracy,
+    DBScore.mods, DBScore.mode, DBScore.relax,
+]
+
+logger = get_logger("recalculation")
+
+@dataclass
+class RecalculationProgress:
+    total_beatmaps: int = 0
+    done_beatmaps: int = 0
+    scores: int = 0
+    updated: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+
+    def __repr__(self) -> str:
+        percent = self.done_beatmaps / self.total_beatmaps * 100 if self.total_beatmaps else 100
+        return f"{self.done_beatmaps}/{self.total_beatmaps} beatmaps ({percent:.1f}%), {self.updated}/{self.scores} scores updated, {self.failed} failed, {self.elapsed:.0f}s elapsed"
+
+def _score_filters(server: str | None, mode: int | None, relax: int | None, pp_system: str | None) -> list:
+    filters = []
+    if server is not None:
+        filters.append(DBScore.server == server)
+    if mode is not None:
+        filters.append(DBScore.mode == mode)
+    if relax is not None:
+        filters.append(DBScore.relax == relax)
+    if pp_system is not None:
+        filters.append(DBScore.pp_system == pp_system)
+    return filters
+
+def recalculate_scores(scores: List[DBScore]) -> Tuple[List[dict], int]:
+    # Imported here so the process pool workers only load the calculators they run
+    from common.performance import by_version
+    import common.servers as servers
+
+    by_system: Dict[str, List[DBScore]] = {}
+    failed = 0
+    for score in scores:
+        if not (server := servers.by_name(score.server)) or not (system := server.get_pp_system(score.mode, score.relax)):
+            failed += 1
+            continue
+        by_system.setdefault(system, []).append(score)
+
+    now = datetime.now()
+    mappings = []
+    for name, system_scores in by_system.items():
+        if not (system := by_version(name)):
+            logger.warning(f"Unknown performance system {name}, skipping {len(system_scores)} scores")
+            failed += len(system_scores)
+            continue
+        for score, result in zip(system_scores, system.calculate_db_scores(system_scores)):
+            if not result.ok:
+                failed += 1
+                continue
+            mappings.append({
+                'id': score.id,
+                'server': score.server,
+                'pp': result.pp,
+                'pp_system': name,
+                'last_updated': now,
+            })
+    return mappings, failed
+
+def _recalculate_shard(beatmap_ids: List[int], filters: Tuple, chunk_size: int) -> Tuple[int, int, int]:
+    # Streamed and committed in chunks, popular maps can have hundreds of thousands of scores
+    query = select(*SCORE_COLUMNS).where(
+        DBScore.beatmap_id.in_(beatmap_ids),
+        *_score_filters(*filters)
+    ).order_by(DBScore.beatmap_id)
+    scores = updated = failed = 0
+    with database.managed_session() as read_session:
+        result = read_session.execute(query.execution_options(stream_results=True, yield_per=chunk_size))
+        for rows in result.partitions(chunk_size):
+            mappings, chunk_failed = recalculate_scores([DBScore(**row._mapping) for row in rows])
+            with database.managed_session() as session:
+                session.bulk_update_mappings(DBScore, mappings)
+                session.commit()
+            scores += len(rows)
+            updated += len(mappings)
+            failed += chunk_failed
+            if app.STOPPED:
+                break
+    return scores, updated, failed
+
+def _shards(score_counts: List[Tuple[int, int]], shard_scores: int) -> List[List[int]]:
+    # Consecutive beatmaps until a shard holds about shard_scores scores, so every beatmap
+    # lives in exactly one shard and is parsed by a single worker
+    shards = []
+    shard, count = [], 0
+    for beatmap_id, scores in score_counts:
+        shard.append(beatmap_id)
+        count += scores
+        if count >= shard_scores:
+            shards.append(shard)
+            shard, count = [], 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+def recalculate(
+    server: str | None = None,
+    mode: int | None = None,
+    relax: int | None = None,
+    pp_system: str | None = None,
+    workers: int | None = None,
+    shard_scores: int = 50000,
+    chunk_size: int = 2000,
+    progress: Callable[[RecalculationProgress], None] | None = None
+) -> RecalculationProgress:
+    filters = (server, mode, relax, pp_system)
+    with database.managed_session() as session:
+        score_counts = (
+            session.query(DBScore.beatmap_id, func.count())
+            .filter(*_score_filters(*filters))
+            .group_by(DBScore.beatmap_id)
+            .order_by(DBScore.beatmap_id)
+            .all()
+        )
+
+    shards = _shards(score_counts, shard_scores)
+    status = RecalculationProgress(total_beatmaps=len(score_counts))
+    workers = workers or os.cpu_count() or 1
+    logger.info(f"Recalculating {sum(count for _, count in score_counts)} scores on {len(score_counts)} beatmaps with {workers} workers")
+
+    start = time.time()
+    last_report = 0.0
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(_recalculate_shard, shard, filters, chunk_size): len(shard) for shard in shards}
+        for future in as_completed(futures):
+            try:
+                scores, updated, failed = future.result()
+                status.scores += scores
+                status.updated += updated
+                status.failed += failed
+            except:
+                logger.error("Recalculation shard failed!", exc_info=True)
+            status.done_beatmaps += futures[future]
+            status.elapsed = time.time() - start
+            if progress:
+                progress(status)
+            if status.elapsed - last_report >= 30 or status.done_beatmaps == status.total_beatmaps:
+                logger.info(f"Recalculation progress: {status}")
+                last_report = status.elapsed
+            if app.STOPPED:
+                logger.info("Stopping recalculation...")
+                pool.shutdown(wait=True, cancel_futures=True)
+                break
+    return status
+
+def recalculate_outdated(
+    system_key: str,
+    server: str | None = None,
+    chunk_size: int = 2000,
+    page_size: int = 100000,
+    checkpoint: str | None = None,
+    reset: bool = False,
+    progress: Callable[[RecalculationProgress], None] | None = None
+) -> RecalculationProgress:
+    from common.performance import performance_systems
+    
+    system = performance_systems[system_key]
+    family = system.name.rsplit("_", 1)[0]
+    checkpoint = checkpoint or f"outdated:{system_key}:{server or 'all'}"
+    # Only scores computed by an older version of the same calculator
+    filters = [
+        DBScore.pp_system.startswith(f"{family}_", autoescape=True),
+        DBScore.pp_system != system.name,
+    ]
+    if server is not None:
+        filters.append(DBScore.server == server)
+
+    status = RecalculationProgress()
+    last_key = None
+    with database.managed_session() as session:
+        if (state := session.get(DBRecalculationCheckpoint, checkpoint)) and state.pp_system == system.name and not reset:
+            if state.completed:
+                logger.info(f"Recalculation {checkpoint} already completed")
+                return status
+            last_key = (state.server, state.score_id)
+            status.scores = state.processed
+            logger.info(f"Resuming recalculation {checkpoint} from {last_key} ({state.processed} scores processed)")
+
+    start = time.time()
+    while not app.STOPPED:
+        query = select(*SCORE_COLUMNS).where(*filters)
+        if last_key:
+            query = query.where(tuple_(DBScore.server, DBScore.id) > tuple_(literal(last_key[0]), literal(last_key[1])))
+        query = query.order_by(DBScore.server, DBScore.id).limit(page_size)
+
+        rows_in_page = 0
+        with database.managed_session() as read_session:
+            result = read_session.execute(query.execution_options(stream_results=True, yield_per=chunk_size))
+            for rows in result.partitions(chunk_size):
+                rows_in_page += len(rows)
+                scores = [DBScore(**row._mapping) for row in rows]
+                mappings, failed = recalculate_scores(scores)
+                last_key = (rows[-1].server, rows[-1].id)
+                status.scores += len(rows)
+                status.updated += len(mappings)
+                status.failed += failed
+                with database.managed_session() as session:
+                    session.bulk_update_mappings(DBScore, mappings)
+                    session.merge(DBRecalculationCheckpoint(
+                        name=checkpoint,
+                        pp_system=system.name,
+                        server=last_key[0],
+                        score_id=last_key[1],
+                        processed=status.scores,
+                        completed=False,
+                        last_updated=datetime.now(),
+                    ))
+                    session.commit()
+                status.elapsed = time.time() - start
+                if progress:
+                    progress(status)
+                if app.STOPPED:
+                    break
+        logger.info(f"Recalculation {checkpoint}: {status.updated}/{status.scores} scores updated, {status.failed} failed, last key {last_key}")
+        if rows_in_page < page_size and not app.STOPPED:
+            with database.managed_session() as session:
+                if (state := session.get(DBRecalculationCheckpoint, checkpoint)):
+                    state.completed = True
+                    state.last_updated = datetime.now()
+                    session.commit()
+            break
+    return status
@@ -1,28 +1,294 @@
-from common.utils import OSSAPI_GAMEMODES, download_beatmap, _try_multiple
-from common.database.objects import DBBeatmapset, DBBeatmap
+from common.utils import OSSAPI_GAMEMODES, LRUCache, FAILED_RETRY_TTL, download_beatmap, beatmap_failed, mark_beatmap_failed, failed_beatmaps, _try_multiple
+from common.database.objects import DBBeatmapset, DBBeatmap, DBUser
+from common.constants import BeatmapStatus
 from common.database.wrapper import session_wrapper
-from common.app import ossapi, database, config
-from common.files import BinaryFile, exists
+from common.app import ossapi, database
+from common.beatmap_archive import beatmap_archive
+from common.beatmap_store import beatmap_store
 from common.logging import get_logger
 from ossapi import Beatmap, Beatmapset
-from typing import Tuple
+from typing import Dict, Iterable, List, Tuple
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy import inspect, event, update, func, or_, not_
 
 import common.servers as servers
+import threading
+import queue
+import copy
 import time
 
 logger = get_logger("repos.beatmaps")
 
-def _get_username(user_id: int) -> str:
-    try:
-        if (user := ossapi.user(user_id)):
-            return user.username
-    except ValueError:
-        pass
-    return None
+# Maximum amount of ids accepted by the /beatmaps endpoint
+BEATMAPS_BATCH_SIZE = 50
+# Titanic BSS beatmaps can't be resolved at all, only remember them to log once a day
+BSS_FAILED_TTL = 86400
+
+# Column snapshots of recently used beatmaps and sets, expiring depending on their status
+beatmap_cache = LRUCache(max_entries=100000)
+beatmapset_cache = LRUCache(max_entries=50000)
+FINAL_STATUSES = {BeatmapStatus.Ranked, BeatmapStatus.Approved, BeatmapStatus.Loved}
+PENDING_STATUSES = {BeatmapStatus.WIP, BeatmapStatus.Pending, BeatmapStatus.Qualified}
+PENDING_TTL = 300
+DEFAULT_TTL = 3600
+
+# Nominator names, fetched again from the API once a day to pick up name changes
+username_cache = LRUCache(max_entries=10000, ttl=86400)
+
+def _cache_ttl(statuses: Iterable[dict | None]) -> float | None:
+    values = set()
+    for status in statuses:
+        # Servers without a status yet are still being resolved
+        if not status or len(status) < len(servers.servers):
+            return PENDING_TTL
+        values.update(status.values())
+    if values and values <= FINAL_STATUSES:
+        return None # Metadata of ranked and loved maps doesn't change anymore
+    if values & PENDING_STATUSES:
+        return PENDING_TTL
+    return DEFAULT_TTL
+
+def _snapshot(obj) -> dict:
+    return {column.key: copy.deepcopy(getattr(obj, column.key)) for column in inspect(obj).mapper.column_attrs}
+
+def _restore(cls, values: dict):
+    obj = cls(**copy.deepcopy(values))
+    make_transient_to_detached(obj)
+    return obj
+
+def _cache_beatmap(dbmap: DBBeatmap):
+    dbset = _snapshot(dbmap.beatmapset) if dbmap.beatmapset else None
+    beatmap_cache.set(dbmap.id, (_snapshot(dbmap), dbset), ttl=_cache_ttl([dbmap.status]))
+
+def _cached_beatmap(beatmap_id: int, session: Session) -> DBBeatmap | None:
+    if not (cached := beatmap_cache.get(beatmap_id)):
+        return None
+    dbmap = _restore(DBBeatmap, cached[0])
+    set_committed_value(dbmap, 'beatmapset', _restore(DBBeatmapset, cached[1]) if cached[1] else None)
+    # Attach it to the session without querying, so callers can keep modifying it like before
+    dbmap = session.merge(dbmap, load=False)
+    if dbmap.beatmapset:
+        session.expunge(dbmap.beatmapset)
+    return dbmap
+
+def _cache_beatmapset(dbset: DBBeatmapset, session: Session):
+    statuses = [row[0] for row in session.query(DBBeatmap.status).filter(DBBeatmap.set_id == dbset.id)]
+    beatmapset_cache.set(dbset.id, _snapshot(dbset), ttl=_cache_ttl(statuses) if statuses else PENDING_TTL)
+
+def _cached_beatmapset(beatmapset_id: int, session: Session) -> DBBeatmapset | None:
+    if not (cached := beatmapset_cache.get(beatmapset_id)):
+        return None
+    return session.merge(_restore(DBBeatmapset, cached), load=False)
+
+def invalidate_beatmap(beatmap_id: int):
+    beatmap_cache.invalidate(beatmap_id)
+
+def invalidate_beatmapset(beatmapset_id: int):
+    beatmapset_cache.invalidate(beatmapset_id)
+
+def cache_stats() -> dict:
+    return {
+        'beatmaps': beatmap_cache.stats(),
+        'beatmapsets': beatmapset_cache.stats(),
+    }
+
+# Beatmaps without a status for a server haven't been resolved there yet
+STATUS_BATCH_SIZE = 50
+STATUS_SWEEP_INTERVAL = 600
+# Failed lookups are retried after these delays, then left alone until the sweeping service restarts
+STATUS_RETRY_DELAYS = [60, 600, 3600, 21600]
+
+class StatusRequest:
+    # Returned by MapStatusResolver.enqueue, to wait for exactly the beatmaps that were queued
+
+    def __init__(self, count: int) -> None:
+        self.remaining = count
+        self.failed: List[Tuple[str, int]] = []
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        if not count:
+            self._done.set()
+
+    def _finish(self, server_name: str, beatmap_id: int, resolved: bool):
+        with self._lock:
+            if not resolved:
+                self.failed.append((server_name, beatmap_id))
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self._done.set()
+
+    def wait(self, timeout: float | None = None) -> bool:
+        return self._done.wait(timeout)
+
+class MapStatusResolver:
+
+    def __init__(self) -> None:
+        self.queues: Dict[str, queue.Queue] = {}
+        self.threads: Dict[str, threading.Thread] = {}
+        # Queued beatmap ids of every server, with the requests waiting for them
+        self.waiters: Dict[str, Dict[int, List[StatusRequest]]] = {}
+        # (server name, beatmap id) -> (failed attempts, next retry)
+        self.failures: Dict[Tuple[str, int], Tuple[int, float]] = {}
+        self.sweeping = False
+        self._lock = threading.Lock()
+
+    def enqueue(self, beatmap_ids: Iterable[int], server_names: Iterable[str] | None = None) -> StatusRequest:
+        if server_names is None:
+            server_names = [server.server_name for server in servers.servers if server.server_name != 'bancho']
+        beatmap_ids = list(dict.fromkeys(beatmap_ids))
+        server_names = list(server_names)
+        request = StatusRequest(len(beatmap_ids) * len(server_names))
+        for server_name in server_names:
+            server_queue = self._queue(server_name)
+            with self._lock:
+                waiters = self.waiters[server_name]
+                beatmap_ids_to_queue = [beatmap_id for beatmap_id in beatmap_ids if beatmap_id not in waiters]
+                for beatmap_id in beatmap_ids:
+                    waiters.setdefault(beatmap_id, []).append(request)
+            for beatmap_id in beatmap_ids_to_queue:
+                server_queue.put(beatmap_id)
+        return request
+
+    def start(self, server_names: Iterable[str] | None = None):
+        # Meant for a single long-running service: it resolves what every other process left
+        # unresolved, so only this one process puts load on the servers
+        if server_names is None:
+            server_names = [server.server_name for server in servers.servers]
+        self.sweeping = True
+        threading.Thread(target=self._sweep, args=(list(server_names),), name="map-status-sweep", daemon=True).start()
+
+    def _sweep(self, server_names: List[str]):
+        while True:
+            for server_name in server_names:
+                try:
+                    if (swept := self.sweep(server_name)):
+                        logger.info(f"Resolving {swept} unresolved map statuses on {server_name}")
+                except:
+                    logger.exception(f"Failed to sweep unresolved map statuses on {server_name}")
+            time.sleep(STATUS_SWEEP_INTERVAL)
+
+    def sweep(self, server_name: str) -> int:
+        with database.managed_session() as session:
+            beatmap_ids = [
+                beatmap_id for beatmap_id, in session.query(DBBeatmap.id)
+                .filter(or_(DBBeatmap.status.is_(None), not_(DBBeatmap.status.has_key(server_name))))
+            ]
+        now = time.time()
+        with self._lock:
+            beatmap_ids = [beatmap_id for beatmap_id in beatmap_ids if self.failures.get((server_name, beatmap_id), (0, 0))[1] <= now]
+        self.enqueue(beatmap_ids, [server_name])
+        return len(beatmap_ids)
+
+    def join(self):
+        for server_queue in list(self.queues.values()):
+            server_queue.join()
+
+    def pending(self) -> Dict[str, int]:
+        return {server_name: server_queue.qsize() for server_name, server_queue in self.queues.items()}
 
-def _from_api_beatmap(beatmap: Beatmap) -> DBBeatmap:
+    def _queue(self, server_name: str) -> queue.Queue:
+        with self._lock:
+            if server_name not in self.queues:
+                # One worker per server, so each one only waits on its own rate limit
+                self.queues[server_name] = queue.Queue()
+                self.waiters[server_name] = {}
+                self.threads[server_name] = threading.Thread(target=self._run, args=(server_name,), name=f"map-status-{server_name}", daemon=True)
+                self.threads[server_name].start()
+            return self.queues[server_name]
+
+    def _run(self, server_name: str):
+        server = servers.by_name(server_name)
+        server_queue = self.queues[server_name]
+        while True:
+            batch = [server_queue.get()]
+            while len(batch) < STATUS_BATCH_SIZE:
+                try:
+                    batch.append(server_queue.get_nowait())
+                except queue.Empty:
+                    break
+            statuses = {}
+            try:
+                statuses = server.get_map_statuses(batch)
+                self._store(server_name, statuses)
+            except:
+                logger.exception(f"Failed to resolve statuses of {len(batch)} beatmaps on {server_name}")
+                statuses = {}
+            finally:
+                self._finish(server_name, batch, statuses)
+                for _ in batch:
+                    server_queue.task_done()
+
+    def _finish(self, server_name: str, beatmap_ids: List[int], statuses: Dict[int, int]):
+        now = time.time()
+        with self._lock:
+            for beatmap_id in beatmap_ids:
+                key = (server_name, beatmap_id)
+                if beatmap_id in statuses:
+                    self.failures.pop(key, None)
+                    continue
+                attempts = self.failures.get(key, (0, 0))[0] + 1
+                delay = STATUS_RETRY_DELAYS[attempts - 1] if attempts <= len(STATUS_RETRY_DELAYS) else float('inf')
+                self.failures[key] = (attempts, now + delay)
+            waiters = [(beatmap_id, self.waiters[server_name].pop(beatmap_id, [])) for beatmap_id in beatmap_ids]
+        for beatmap_id, requests in waiters:
+            for request in requests:
+                request._finish(server_name, beatmap_id, beatmap_id in statuses)
+
+    def _store(self, server_name: str, statuses: Dict[int, int]):
+        by_status: Dict[int, List[int]] = {}
+        for beatmap_id, status in statuses.items():
+            by_status.setdefault(status, []).append(beatmap_id)
+        with database.managed_session() as session:
+            for status, beatmap_ids in by_status.items():
+                # Merge into the json column, so concurrent workers don't overwrite each other
+                session.execute(
+                    update(DBBeatmap)
+                    .where(DBBeatmap.id.in_(beatmap_ids))
+                    .values(status=func.coalesce(DBBeatmap.status, func.jsonb_build_object()).op('||')(func.jsonb_build_object(server_name, status)))
+                    .execution_options(synchronize_session=False)
+                )
+            session.commit()
+        for beatmap_id in statuses:
+            invalidate_beatmap(beatmap_id)
+
+status_resolver = MapStatusResolver()
+
+@event.listens_for(Session, "after_commit")
+def _resolve_committed_statuses(session: Session):
+    # Only resolve once the beatmaps exist, otherwise the merge would overwrite the result.
+    # Other processes leave them to the service that started the resolver, it sweeps them up.
+    if (beatmap_ids := session.info.pop('unresolved_statuses', None)) and status_resolver.sweeping:
+        status_resolver.enqueue(beatmap_ids)
+
+def _get_usernames(user_ids: Iterable[int], session: Session) -> Dict[int, str]:
+    usernames = {}
+    missing = set()
+    for user_id in user_ids:
+        if (username := username_cache.get(user_id)):
+            usernames[user_id] = username
+        else:
+            missing.add(user_id)
+    failed = set()
+    for user_id in sorted(missing):
+        try:
+            if (user := ossapi.user(user_id)):
+                usernames[user_id] = user.username
+                username_cache.set(user_id, user.username)
+                continue
+        except Exception as e:
+            logger.warning(f"Failed to get nominator {user_id} ({e})")
+        failed.add(user_id)
+    if failed:
+        # Tracked players may still have a name on record, it's only kept until the API answers again
+        for user_id, username in session.query(DBUser.id, DBUser.username).filter(DBUser.server == 'bancho', DBUser.id.in_(failed)):
+            if username:
+                usernames[user_id] = username
+                username_cache.set(user_id, username, ttl=FAILED_RETRY_TTL)
+    return usernames
+
+def _from_api_beatmap(beatmap: Beatmap, status: dict | None = None) -> DBBeatmap:
     if not download_beatmap(beatmap.id, check_MD5=beatmap.checksum):
         logger.warn(f"Failed to download beatmap {beatmap.id}!")
     dbmap = DBBeatmap(
@@ -45,16 +311,12 @@ def _from_api_beatmap(beatmap: Beatmap) -> DBBeatmap:
         count_sliders=beatmap.count_sliders,
         count_spinners=beatmap.count_spinners,
     )
-    dbmap.status = {
-        'bancho': beatmap.status.value
-    }
-    for server in servers.servers:
-        if server.server_name == 'bancho':
-            continue
-        dbmap.status[server.server_name] = server.get_map_status(beatmap.id)
+    # Other servers are resolved in the background, keep what we know until then
+    dbmap.status = dict(status or {})
+    dbmap.status['bancho'] = beatmap.status.value
     return dbmap
 
-def _from_api_beatmapset(beatmapset: Beatmapset) -> DBBeatmapset:
+def _from_api_beatmapset(beatmapset: Beatmapset, session: Session) -> DBBeatmapset:
     dbset = DBBeatmapset(
         id=beatmapset.id,
         artist=beatmapset.artist,
@@ -78,8 +340,9 @@ def _from_api_beatmapset(beatmapset: Beatmapset) -> DBBeatmapset:
         dbset.language = beatmapset.language['name']
     noms = []
     if beatmapset.current_nominations:
+        usernames = _get_usernames([nom.user_id for nom in beatmapset.current_nominations], session)
         for nom in beatmapset.current_nominations:
-            if (nom_user := _get_username(nom.user_id)):
+            if (nom_user := usernames.get(nom.user_id)):
                 noms.append(nom_user)
     dbset.nominators = {
         'bancho': noms,
@@ -88,17 +351,44 @@ def _from_api_beatmapset(beatmapset: Beatmapset) -> DBBeatmapset:
     }
     return dbset
 
+def _fetch_beatmapset(beatmapset_id: int, session: Session) -> DBBeatmapset:
+    beatmapset = _try_multiple(ossapi.beatmapset, beatmapset_id)
+    dbset = _from_api_beatmapset(beatmapset, session)
+    session.merge(dbset)
+    invalidate_beatmapset(beatmapset.id)
+    statuses = dict(session.query(DBBeatmap.id, DBBeatmap.status).filter(DBBeatmap.set_id == beatmapset.id))
+    for beatmap in beatmapset.beatmaps:
+        session.merge(_from_api_beatmap(beatmap, statuses.get(beatmap.id)))
+        invalidate_beatmap(beatmap.id)
+        failed_beatmaps.invalidate(('metadata', beatmap.id))
+    session.info.setdefault('unresolved_statuses', set()).update(beatmap.id for beatmap in beatmapset.beatmaps)
+    return dbset
+
+def _fetch_beatmapsets(beatmapset_ids: Iterable[int], session: Session) -> set:
+    fetched = set()
+    for beatmapset_id in beatmapset_ids:
+        try:
+            # Savepoint per set, so a failed set doesn't leave half of its beatmaps behind
+            with session.begin_nested():
+                _fetch_beatmapset(beatmapset_id, session)
+            fetched.add(beatmapset_id)
+        except:
+            logger.exception(f"Failed to get beatmapset {beatmapset_id}")
+        time.sleep(0.4)
+    return fetched
+
 @session_wrapper
 def get_beatmapset(beatmapset_id: int, force_fetch: bool = False, session: Session | None = None) -> DBBeatmapset | None:
+    if force_fetch:
+        invalidate_beatmapset(beatmapset_id)
+    elif (dbset := _cached_beatmapset(beatmapset_id, session)):
+        return dbset
     if (dbset := session.query(DBBeatmapset).filter(DBBeatmapset.id == beatmapset_id).first()) and not force_fetch:
+        _cache_beatmapset(dbset, session)
         return dbset
     else:
         try:
-            beatmapset = _try_multiple(ossapi.beatmapset, beatmapset_id)
-            dbset = _from_api_beatmapset(beatmapset)
-            session.merge(dbset)
-            for beatmap in beatmapset.beatmaps:
-                session.merge(_from_api_beatmap(beatmap))
+            dbset = _fetch_beatmapset(beatmapset_id, session)
             session.commit()
             time.sleep(0.4)
             return dbset
@@ -106,31 +396,121 @@ def get_beatmapset(beatmapset_id: int, force_fetch: bool = False, session: Sessi
             logger.exception(f"Failed to get beatmapset {beatmapset_id}")
             return None
 
+@session_wrapper
+def get_beatmapsets(beatmapset_ids: Iterable[int], force_fetch: bool = False, session: Session | None = None) -> Dict[int, DBBeatmapset]:
+    beatmapset_ids = set(beatmapset_ids)
+    dbsets = {}
+    if not force_fetch:
+        for beatmapset_id in beatmapset_ids:
+            if (dbset := _cached_beatmapset(beatmapset_id, session)):
+                dbsets[beatmapset_id] = dbset
+        if (uncached := beatmapset_ids - dbsets.keys()):
+            for dbset in session.query(DBBeatmapset).filter(DBBeatmapset.id.in_(uncached)):
+                _cache_beatmapset(dbset, session)
+                dbsets[dbset.id] = dbset
+    if (missing := beatmapset_ids - dbsets.keys()):
+        # osu! has no multi-set endpoint, but everything is merged in a single transaction
+        fetched = _fetch_beatmapsets(sorted(missing), session)
+        session.commit()
+        dbsets.update({dbset.id: dbset for dbset in session.query(DBBeatmapset).filter(DBBeatmapset.id.in_(fetched))})
+    return dbsets
+
 @session_wrapper
 def get_beatmap(beatmap_id: int, force_fetch: bool = False, session: Session | None = None) -> DBBeatmap | None:
     if beatmap_id > 1000000000:
-        logger.warning(f"WARNING: {beatmap_id} is a titanic BSS (Not implemented)")
+        if not beatmap_failed('metadata', beatmap_id):
+            logger.warning(f"WARNING: {beatmap_id} is a titanic BSS (Not implemented)")
+            mark_beatmap_failed('metadata', beatmap_id, ttl=BSS_FAILED_TTL)
         return None
+    if force_fetch:
+        invalidate_beatmap(beatmap_id)
+    elif (dbmap := _cached_beatmap(beatmap_id, session)):
+        return dbmap
     if (dbmap := session.query(DBBeatmap).filter(DBBeatmap.id == beatmap_id).first()) and not force_fetch:
+        _cache_beatmap(dbmap)
         session.expunge(dbmap.beatmapset)
         return dbmap
+    elif not force_fetch and beatmap_failed('metadata', beatmap_id):
+        return None
     else:
         try:
-            beatmap = _try_multiple(ossapi.beatmap, beatmap_id)
-            if get_beatmapset(beatmap.beatmapset_id, force_fetch=force_fetch, session=session):
+            # Unlike /beatmaps/{id}, the batch endpoint answers unknown beatmaps with an empty list instead of an error
+            beatmaps = _try_multiple(ossapi.beatmaps, [beatmap_id])
+            if beatmaps == []:
+                mark_beatmap_failed('metadata', beatmap_id)
+                return None
+            if beatmaps and get_beatmapset(beatmaps[0].beatmapset_id, force_fetch=force_fetch, session=session):
                 session.commit()
                 beatmap = session.get(DBBeatmap, (beatmap_id))
+                _cache_beatmap(beatmap)
                 session.expunge(beatmap.beatmapset)
                 return beatmap
         except:
             logger.exception(f"Failed to get beatmap {beatmap_id}")
-            return None
+        mark_beatmap_failed('metadata', beatmap_id, ttl=FAILED_RETRY_TTL)
+        return None
             
-def get_beatmap_file(beatmap_id: int) -> Tuple[bytes, str]:
+@session_wrapper
+def get_beatmaps(beatmap_ids: Iterable[int], force_fetch: bool = False, session: Session | None = None) -> Dict[int, DBBeatmap]:
+    beatmap_ids = set(beatmap_ids)
+    if (bss := {beatmap_id for beatmap_id in beatmap_ids if beatmap_id > 1000000000}):
+        if (new_bss := sorted(beatmap_id for beatmap_id in bss if not beatmap_failed('metadata', beatmap_id))):
+            logger.warning(f"WARNING: {len(new_bss)} titanic BSS beatmaps requested (Not implemented)")
+            for beatmap_id in new_bss:
+                mark_beatmap_failed('metadata', beatmap_id, ttl=BSS_FAILED_TTL)
+        beatmap_ids -= bss
+    dbmaps = {}
+    if not force_fetch:
+        for beatmap_id in beatmap_ids:
+            if (dbmap := _cached_beatmap(beatmap_id, session)):
+                dbmaps[beatmap_id] = dbmap
+        if (uncached := beatmap_ids - dbmaps.keys()):
+            for dbmap in session.query(DBBeatmap).filter(DBBeatmap.id.in_(uncached)):
+                _cache_beatmap(dbmap)
+                dbmaps[dbmap.id] = dbmap
+    missing = beatmap_ids - dbmaps.keys()
+    if not force_fetch:
+        missing = {beatmap_id for beatmap_id in missing if not beatmap_failed('metadata', beatmap_id)}
+    if (missing := sorted(missing)):
+        # The multi-beatmap endpoint lacks set metadata (tags, nominators...), so it's only used to find the sets
+        beatmapset_ids = set()
+        unknown = set()
+        for i in range(0, len(missing), BEATMAPS_BATCH_SIZE):
+            batch = missing[i:i+BEATMAPS_BATCH_SIZE]
+            if (beatmaps := _try_multiple(ossapi.beatmaps, batch)) is not None:
+                beatmapset_ids.update(beatmap.beatmapset_id for beatmap in beatmaps)
+                unknown.update(set(batch) - {beatmap.id for beatmap in beatmaps})
+            time.sleep(0.4)
+        if beatmapset_ids:
+            _fetch_beatmapsets(sorted(beatmapset_ids), session)
+            session.commit()
+            for dbmap in session.query(DBBeatmap).filter(DBBeatmap.id.in_(missing)):
+                _cache_beatmap(dbmap)
+                dbmaps[dbmap.id] = dbmap
+        for beatmap_id in set(missing) - dbmaps.keys():
+            # Only beatmaps the API doesn't know about are remembered for long
+            mark_beatmap_failed('metadata', beatmap_id, ttl=None if beatmap_id in unknown else FAILED_RETRY_TTL)
+    expunged = set()
+    for dbmap in dbmaps.values():
+        if dbmap.beatmapset and dbmap.set_id not in expunged and dbmap.beatmapset in session:
+            session.expunge(dbmap.beatmapset)
+            expunged.add(dbmap.set_id)
+    return dbmaps
+
+def get_beatmap_file(beatmap_id: int) -> Tuple[bytes | memoryview, str]:
+    if not (dbmap := get_beatmap(beatmap_id)):
+        return None
+    if (archive := beatmap_archive()) and (beatmap := archive.get(beatmap_id)):
+        return beatmap
+    if (beatmap := beatmap_store().read(beatmap_id)):
+        return beatmap
+    # Download failures are remembered, so missing files don't hit the mirrors for every score
+    if download_beatmap(beatmap_id, check_MD5=dbmap.md5):
+        return beatmap_store().read(beatmap_id)
+    return None
+
+def get_beatmap_hash(beatmap_id: int) -> str | None:
+    # Answered from the store index, without decompressing the file
     if not get_beatmap(beatmap_id):
         return None
-    file = BinaryFile(f"{config.storage}/beatmaps/{beatmap_id}.osu.gz")
-    if not file.exists():
-        return
-    file.load_data()
-    return file.data, file.get_hash()
+    return beatmap_store().get_hash(beatmap_id)
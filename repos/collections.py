@@ -0,0 +1,107 @@
+from common.database.objects import DBBeatmap, DBBeatmapset, DBBeatmapPack
+from common.collections import CollectionEntry, CollectionWriter
+from common.database.wrapper import session_wrapper
+
+from typing import BinaryIO, Dict, Iterable, List, Set, Tuple
+from sqlalchemy.orm import Session
+from sqlalchemy import select, func
+
+import io
+
+# Everything an entry needs, in the order CollectionWriter.add takes it (the comment is always empty)
+COLLECTION_COLUMNS = [
+    DBBeatmap.id, DBBeatmap.set_id, DBBeatmapset.artist, DBBeatmapset.title,
+    DBBeatmap.version, DBBeatmap.md5, DBBeatmap.mode, DBBeatmap.diff,
+]
+QUERY_BATCH_SIZE = 10000
+
+def status_filter(server: str, statuses: Iterable[int]):
+    return DBBeatmap.status[server].as_integer().in_(list(statuses))
+
+def pack_filter(tags: Iterable[str]):
+    return DBBeatmap.set_id.in_(
+        select(func.unnest(DBBeatmapPack.beatmapsets)).where(DBBeatmapPack.tag.in_(list(tags)))
+    )
+
+def _collection_query(session: Session, filters: list, *columns):
+    return session.query(*columns).select_from(DBBeatmap).join(DBBeatmapset, DBBeatmap.set_id == DBBeatmapset.id).filter(*filters)
+
+@session_wrapper
+def write_collections_from_query(fileobj: BinaryIO, collections: Dict[str, list], session: Session | None = None):
+    # Counts and rows have to agree, so everything is read from one REPEATABLE READ snapshot.
+    # That needs a transaction of our own, one already in progress may see other commits between queries.
+    if session.in_transaction():
+        raise ValueError("write_collections_from_query needs a session that isn't in a transaction")
+    session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+    try:
+        counts = {
+            name: _collection_query(session, filters, func.count()).scalar()
+            for name, filters in collections.items()
+        }
+        with CollectionWriter(fileobj, len(collections)) as writer:
+            for name, filters in collections.items():
+                writer.begin_collection(name, counts[name])
+                rows = _collection_query(session, filters, *COLLECTION_COLUMNS).order_by(DBBeatmap.id).execution_options(stream_results=True).yield_per(QUERY_BATCH_SIZE)
+                for row in rows:
+                    writer.add(*row)
+    finally:
+        session.rollback()
+
+@session_wrapper
+def generate_collection_from_query(filters: list, collection_name, session: Session | None = None):
+    output = io.BytesIO()
+    write_collections_from_query(output, {collection_name: filters}, session=session)
+    return output.getvalue()
+
+@session_wrapper
+def diff_collection(md5s: Set[str], filters: list, session: Session | None = None) -> Tuple[List[tuple], Set[str]]:
+    # Returns the rows matching the filters that aren't in the collection,
+    # and the md5s of the collection that don't match the filters
+    missing = []
+    matched = set()
+    rows = _collection_query(session, filters, *COLLECTION_COLUMNS).order_by(DBBeatmap.id).execution_options(stream_results=True).yield_per(QUERY_BATCH_SIZE)
+    for row in rows:
+        if row.md5 in md5s:
+            matched.add(row.md5)
+        else:
+            missing.append(tuple(row))
+    return missing, md5s - matched
+
+@session_wrapper
+def lookup_md5s(md5s: Iterable[str], session: Session | None = None) -> Dict[str, tuple]:
+    md5s = list(md5s)
+    found = {}
+    for i in range(0, len(md5s), QUERY_BATCH_SIZE):
+        for row in _collection_query(session, [DBBeatmap.md5.in_(md5s[i:i+QUERY_BATCH_SIZE])], *COLLECTION_COLUMNS):
+            found[row.md5] = tuple(row)
+    return found
+
+@session_wrapper
+def write_missing_collection(fileobj: BinaryIO, md5s: Set[str], filters: list, collection_name, session: Session | None = None) -> int:
+    # e.g. the maps of a pack that aren't in an uploaded collection yet
+    missing, _ = diff_collection(md5s, filters, session=session)
+    with CollectionWriter(fileobj, 1) as writer:
+        writer.begin_collection(collection_name, len(missing))
+        for row in missing:
+            writer.add(*row)
+    return len(missing)
+
+@session_wrapper
+def merge_collections(fileobj: BinaryIO, sources: Iterable[Iterable[CollectionEntry]], collection_name, session: Session | None = None) -> int:
+    entries: Dict[str, CollectionEntry] = {}
+    for source in sources:
+        for entry in source:
+            # Prefer an entry that comes with metadata over a hash-only one
+            if entry.md5 not in entries or entries[entry.md5].hash_only:
+                entries[entry.md5] = entry
+    # Hash-only entries get their metadata from the database, in one query per batch
+    known = lookup_md5s([md5 for md5, entry in entries.items() if entry.hash_only], session=session)
+    unknown = [md5 for md5, entry in entries.items() if entry.hash_only and md5 not in known]
+    with CollectionWriter(fileobj, 1) as writer:
+        writer.begin_collection(collection_name, len(entries) - len(unknown), hashes=unknown)
+        for md5, entry in entries.items():
+            if not entry.hash_only:
+                writer.add(entry.beatmap_id, entry.set_id, entry.artist, entry.title, entry.version, entry.md5, entry.mode, entry.diff, entry.comment)
+            elif md5 in known:
+                writer.add(*known[md5])
+    return len(entries)
@@ -0,0 +1,36 @@
+from common.database.objects import DBPerformanceCurve
+from common.database.wrapper import session_wrapper
+from common.constants import Mods
+
+from sqlalchemy.orm import Session
+from datetime import datetime
+from typing import Dict, Iterable, List
+
+def curve_mods(mods: int) -> int:
+    # Mods that don't change pp at all, NoVideo is TouchDevice and stays
+    return int(mods) & ~(Mods.SuddenDeath | Mods.Perfect)
+
+@session_wrapper
+def get_curve(beatmap_id: int, mode: int, mods: int, pp_system: str, session: Session | None = None) -> DBPerformanceCurve | None:
+    if (curve := session.get(DBPerformanceCurve, (beatmap_id, mode, curve_mods(mods), pp_system))):
+        session.expunge(curve)
+    return curve
+
+@session_wrapper
+def get_curves(beatmap_ids: Iterable[int], mode: int, mods: int, pp_system: str, session: Session | None = None) -> Dict[int, DBPerformanceCurve]:
+    curves = session.query(DBPerformanceCurve).filter(
+        DBPerformanceCurve.beatmap_id.in_(list(beatmap_ids)),
+        DBPerformanceCurve.mode == mode,
+        DBPerformanceCurve.mods == curve_mods(mods),
+        DBPerformanceCurve.pp_system == pp_system,
+    ).all()
+    session.expunge_all()
+    return {curve.beatmap_id: curve for curve in curves}
+
+@session_wrapper
+def store_curves(curves: List[DBPerformanceCurve], session: Session | None = None):
+    for curve in curves:
+        curve.mods = curve_mods(curve.mods)
+        curve.last_updated = datetime.now()
+        session.merge(curve)
+    session.commit()
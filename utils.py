@@ -1,12 +1,13 @@
 from common.logging import get_logger
 from common.constants import Mods
 
-from common.files import BinaryFile, exists
-from common.app import config
+from common.beatmap_store import beatmap_store
 
 from datetime import datetime, timedelta
-from typing import Optional
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Optional
 
+import threading
 import requests
 import math
 import time
@@ -15,72 +16,85 @@ OSSAPI_GAMEMODES = {'osu': 0, 'taiko': 1, 'fruits': 2, 'mania': 3}
 DEFAULT_HEADERS = {"user-agent": "akatsukialt!/KompirBot fetch service"}
 logger = get_logger("utils")
 
+# Called with the beatmap id every time a beatmap file is replaced on disk
+beatmap_update_handlers: List[Callable[[int], None]] = []
+
 def download_beatmap(beatmap_id, check_MD5: str = None, force_download=False, skip_mirror=False) -> bool:
-    if exists(f"{config.storage}/beatmaps/{beatmap_id}.osu.gz") and not force_download:
+    if beatmap_store().exists(beatmap_id) and not force_download:
         if check_MD5:
-            local_MD5 = BinaryFile(f"{config.storage}/beatmaps/{beatmap_id}.osu.gz").get_hash()
+            local_MD5 = beatmap_store().get_hash(beatmap_id)
             if local_MD5 != check_MD5:
                 logger.warning(f"Found mismatch in MD5 for beatmap {beatmap_id} (local: {local_MD5}, remote: {check_MD5})")
                 return download_beatmap(beatmap_id, force_download=True, skip_mirror=True)
         return True
 
+    if not force_download and beatmap_failed('download', beatmap_id):
+        return False
+
     if not skip_mirror:
         if result := _osudirect_download(beatmap_id):
-            local_MD5 = BinaryFile(f"{config.storage}/beatmaps/{beatmap_id}.osu.gz").get_hash()
+            local_MD5 = beatmap_store().get_hash(beatmap_id)
             if check_MD5 and local_MD5 != check_MD5:
                 logger.warning(f"Mirror likely have outdated beatmap for {beatmap_id} (local: {local_MD5}, remote: {check_MD5})")
             else:
                 return result
 
     # Use old.ppy.sh as backup endpoint
-    return _ppy_download(beatmap_id)
+    if not (result := _ppy_download(beatmap_id)):
+        mark_beatmap_failed('download', beatmap_id, ttl=FAILED_DOWNLOAD_TTL)
+    return result
 
 
-def _osudirect_download(beatmap_id) -> bool:
-    response = requests.get(
-        f"https://osu.direct/api/osu/{beatmap_id}",
+def _save_beatmap(beatmap_id: int, content: bytes):
+    beatmap_store().write(beatmap_id, content)
+    failed_beatmaps.invalidate(('download', beatmap_id))
+    for handler in beatmap_update_handlers:
+        try:
+            handler(beatmap_id)
+        except:
+            logger.error(f"Beatmap update handler failed for {beatmap_id}", exc_info=True)
+
+# Mirrors serving raw .osu files, in order of preference
+BEATMAP_MIRRORS = {
+    'osu.direct': "https://osu.direct/api/osu/{}",
+    'catboy': "https://catboy.best/osu/{}",
+    'old.ppy.sh': "https://old.ppy.sh/osu/{}",
+}
+# (connect, read) timeouts for beatmap downloads
+DOWNLOAD_TIMEOUT = (5, 30)
+
+def _fetch_beatmap(mirror: str, beatmap_id: int, http=requests) -> bytes | None:
+    response = http.get(
+        BEATMAP_MIRRORS[mirror].format(beatmap_id),
         headers=DEFAULT_HEADERS,
+        timeout=DOWNLOAD_TIMEOUT,
     )
-    if not response.ok:
+    if not response.ok or not response.content:
         logger.warning(f"GET {response.url} {response.status_code}")
         #logger.warning(f"{response.text}")
-        return False
+        return None
     #logger.info(f"GET {response.url} {response.status_code}")
-    file = BinaryFile(f"{config.storage}/beatmaps/{beatmap_id}.osu.gz")
-    file.data = response.content
-    file.save_data()
-    return True
+    return response.content
 
-def _catboy_download(beatmap_id) -> bool:
-    response = requests.get(
-        f"https://catboy.best/osu/{beatmap_id}",
-        headers=DEFAULT_HEADERS,
-    )
-    if not response.ok:
-        logger.warning(f"GET {response.url} {response.status_code}")
-        #logger.warning(f"{response.text}")
+def _mirror_download(mirror: str, beatmap_id: int) -> bool:
+    try:
+        content = _fetch_beatmap(mirror, beatmap_id)
+    except requests.RequestException as e:
+        logger.warning(f"Failed to download beatmap {beatmap_id} from {mirror} ({e})")
         return False
-    #logger.info(f"GET {response.url} {response.status_code}")
-    file = BinaryFile(f"{config.storage}/beatmaps/{beatmap_id}.osu.gz")
-    file.data = response.content
-    file.save_data()
+    if not content:
+        return False
+    _save_beatmap(beatmap_id, content)
     return True
 
+def _osudirect_download(beatmap_id) -> bool:
+    return _mirror_download('osu.direct', beatmap_id)
+
+def _catboy_download(beatmap_id) -> bool:
+    return _mirror_download('catboy', beatmap_id)
 
 def _ppy_download(beatmap_id) -> bool:
-    response = requests.get(
-        f"https://old.ppy.sh/osu/{beatmap_id}",
-        headers=DEFAULT_HEADERS,
-    )
-    if not response.ok or not response.content:
-        logger.warning(f"GET {response.url} {response.status_code}")
-        logger.warning(f"{response.text}")
-        return False
-    #logger.info(f"GET {response.url} {response.status_code}")
-    file = BinaryFile(f"{config.storage}/beatmaps/{beatmap_id}.osu.gz")
-    file.data = response.content
-    file.save_data()
-    return True
+    return _mirror_download('old.ppy.sh', beatmap_id)
 
 def try_get(dikt: dict, key: str, default=None):
     try:
@@ -102,6 +116,102 @@ def _try_multiple(func, args, _retries=3, _delay=1) -> Optional[object]:
             time.sleep(_delay)
     return None
 
+class LRUCache:
+    
+    def __init__(self, max_entries: int = 1024, max_bytes: int | None = None, ttl: float | None = None) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict = OrderedDict() # key -> (value, size, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: Hashable, value, size: int = 1, ttl: float | None = None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._entries[key] = (value, size, time.monotonic() + ttl if ttl is not None else None)
+            self.size += size
+            while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            return True
+
+    def invalidate_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self.size -= size
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+# Beatmaps that couldn't be resolved ('metadata') or downloaded ('download'),
+# so ingestion doesn't repeat the whole retry dance for every score on them
+FAILED_BEATMAP_TTL = 3600
+FAILED_DOWNLOAD_TTL = 900
+# API outages, timeouts and database errors, only long enough to not retry on every score
+FAILED_RETRY_TTL = 60
+failed_beatmaps = LRUCache(max_entries=100000, ttl=FAILED_BEATMAP_TTL)
+
+def beatmap_failed(kind: str, beatmap_id: int) -> bool:
+    return failed_beatmaps.get((kind, beatmap_id)) is not None
+
+def mark_beatmap_failed(kind: str, beatmap_id: int, ttl: float | None = None):
+    failed_beatmaps.set((kind, beatmap_id), time.time(), ttl=ttl)
+
 class Schedule:
     
     def __init__(self, hours: int, minutes: int, seconds: int) -> None:
@@ -0,0 +1,122 @@
+# Waits for files to appear using inotify on Linux, polling everywhere else
+from typing import Dict, Iterable, Set
+
+import ctypes.util
+import asyncio
+import ctypes
+import struct
+import errno
+import sys
+import os
+
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+IN_CREATE = 0x100
+IN_MOVED_TO = 0x80
+IN_ONLYDIR = 0x1000000
+IN_Q_OVERFLOW = 0x4000
+
+EVENT_HEADER = struct.Struct("iIII")
+
+_libc = None
+
+def _load_libc():
+    global _libc
+    if _libc is None and sys.platform.startswith("linux"):
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            _libc.inotify_init1.argtypes = [ctypes.c_int]
+            _libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc
+
+class Inotify:
+
+    def __init__(self) -> None:
+        if not (libc := _load_libc()):
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories: Dict[int, str] = {}
+
+    def watch(self, directory: str):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CREATE | IN_MOVED_TO | IN_ONLYDIR)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+        self.directories[wd] = directory
+
+    def read(self) -> Iterable[str]:
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buffer):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buffer, offset)
+            name = buffer[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, callers have to check everything again
+                yield None
+            elif wd in self.directories:
+                yield os.path.join(self.directories[wd], os.fsdecode(name))
+
+    def close(self):
+        os.close(self.fd)
+
+async def _poll(paths: Set[str], timeout: float, interval: float) -> Set[str]:
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        if (found := {path for path in paths if os.path.exists(path)}) == paths or loop.time() >= deadline:
+            return found
+        await asyncio.sleep(min(interval, max(0, deadline - loop.time())))
+
+async def wait_for_paths(paths: Iterable[str], timeout: float = 60, poll_interval: float = 1) -> Set[str]:
+    # Returns the paths that exist once all of them do or the timeout is reached
+    paths = {os.path.abspath(path) for path in paths}
+    try:
+        inotify = Inotify()
+    except OSError:
+        return await _poll(paths, timeout, poll_interval)
+
+    loop = asyncio.get_running_loop()
+    try:
+        for directory in {os.path.dirname(path) for path in paths}:
+            try:
+                inotify.watch(directory)
+            except OSError:
+                # Missing directories can't be watched, fall back to polling everything
+                return await _poll(paths, timeout, poll_interval)
+
+        # Checked after the watches exist, so files created in between aren't missed
+        found = {path for path in paths if os.path.exists(path)}
+        if found == paths:
+            return found
+        changed = asyncio.Event()
+
+        def on_events():
+            for created in inotify.read():
+                if created is None:
+                    found.update(path for path in paths if os.path.exists(path))
+                elif created in paths:
+                    found.add(created)
+            if found == paths:
+                changed.set()
+
+        loop.add_reader(inotify.fd, on_events)
+        try:
+            await asyncio.wait_for(changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(inotify.fd)
+        return {path for path in found if os.path.exists(path)}
+    finally:
+        inotify.close()
+
+async def wait_for_path(path: str, timeout: float = 60, poll_interval: float = 1) -> bool:
+    return bool(await wait_for_paths([path], timeout, poll_interval))